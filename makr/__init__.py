@@ -27,133 +27,1073 @@ import re
 import os
 from pathlib import Path
 import functools
-from collections import deque
+import hashlib
+import heapq
+import json
+import select
+from collections import deque, namedtuple
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 assert sys.version_info.major >= 3 and sys.version_info.minor >= 2
 
-
-def preserve_cwd(function):
-    ''' from https://stackoverflow.com/questions/169070/
-            how-do-i-write-a-decorator-that-restores-the-cwd/ '''
-    @functools.wraps(function)
-    def decorator(*args, **kwargs):
-        cwd = Path.cwd()
-        try:
-            return function(*args, **kwargs)
-        finally:
-            os.chdir(cwd)
-    return decorator
+STATE_DIR = '.makr'
+TASK_LEAVES = ("input", "output", "src", "frozen", "hand")
 
 
 def is_a_task(taskdir):
     ''' tests dir for presence of at least one task leaf '''
-    task_subdirs = ("input", "output", "src", "frozen", "hand")
     taskdir = Path(taskdir).resolve()
     if not taskdir.is_dir():
         return False
     return any(taskdir.joinpath(subdir).is_dir()
-               for subdir in task_subdirs)
+               for subdir in TASK_LEAVES)
 
 
-def get_git_root():
+def get_git_root(cwd=None):
     prox = subprocess.run(['git', 'rev-parse', '--show-toplevel'],
-                          capture_output=True)
+                          capture_output=True, cwd=cwd)
     pth = Path(prox.stdout.strip().decode('utf-8'))
     return str(pth)
 
 
-def get_task_path(tpath):
-    tpath = Path(tpath).resolve()
-    opath = tpath                           # for error reporting
-    git_root = Path(get_git_root())
+class TaskResolver:
+    ''' finds the task holding a path, like get_task_path, but asks git for
+        the root only once and remembers the task (or lack of one) for every
+        directory it walks through, so repeated parents are dict lookups
+    '''
+    def __init__(self, git_root=None, cwd=None):
+        self.git_root = Path(git_root or get_git_root(cwd=cwd))
+        self.home = Path.home()
+        self.tasks = dict()                 # dir -> task path, or None
+
+    def _walk(self, tpath):
+        ''' the first task at or above tpath, or None '''
+        walked = list()
+        task = None
+        while True:
+            if tpath in self.tasks:
+                task = self.tasks[tpath]
+                break
+            walked.append(tpath)
+            if is_a_task(tpath):
+                task = tpath
+                break
+            tpath = tpath.parent
+            if tpath == tpath.parent or tpath == self.home:
+                break
+        for pth in walked:
+            self.tasks[pth] = task
+        return task
 
-    while tpath.is_file() or not is_a_task(tpath):
-        tpath = tpath.parent
-        if tpath == tpath.parent or tpath == Path.home():
+    def task_path(self, tpath, base=None):
+        ''' the task holding tpath; relative paths are taken from base,
+            or from the cwd if base is None '''
+        tpath = Path(base or Path.cwd()).joinpath(tpath).resolve()
+        opath = tpath                       # for error reporting
+        if not tpath.is_dir():
+            tpath = tpath.parent
+            if tpath == tpath.parent or tpath == self.home:
+                raise OSError(f"no task found starting at {opath}")
+        task = self._walk(tpath)
+        if task is None:
             raise OSError(f"no task found starting at {opath}")
 
-    if git_root.parts != tpath.parts[:len(git_root.parts)]:
-        errmsg = f"get_task_path: tpath={tpath} not in git_root={git_root}"
-        raise OSError(errmsg)
+        git_root = self.git_root
+        if git_root.parts != task.parts[:len(git_root.parts)]:
+            errmsg = f"get_task_path: tpath={task} not in git_root={git_root}"
+            raise OSError(errmsg)
+
+        return str(task)
+
+
+def get_task_path(tpath, base=None):
+    ''' the task holding tpath; relative paths are taken from base,
+        or from the cwd if base is None '''
+    return TaskResolver(cwd=base).task_path(tpath, base=base)
+
+
+def hash_file(fname):
+    ''' sha1 of fname's contents, read in chunks '''
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_fingerprint(fname):
+    ''' (mtime_ns, size, sha1) for fname '''
+    st = os.stat(fname)
+    return [st.st_mtime_ns, st.st_size, hash_file(fname)]
+
+
+def state_path(git_root, name):
+    ''' path to one of makr's state files under git_root/.makr '''
+    pth = Path(git_root) / STATE_DIR
+    pth.mkdir(exist_ok=True)
+    return pth / name
+
+
+def makefile_for(task_path):
+    ''' the makefile exec_make would use in task_path, or None '''
+    for mk in ('src/Makefile', 'Makefile'):
+        if Path(task_path).joinpath(mk).exists():
+            return mk
+    return None
+
+
+class DepCache:
+    ''' on-disk cache of each task's prereqs and upstream tasks, kept in
+        git_root/.makr/depcache.json.  an entry is valid while the makefiles
+        make read for the task (incl. includes) and the targets of any
+        symlinked prereqs are unchanged.  makefiles whose mtime or size moved
+        are re-hashed before the entry is thrown out.
+    '''
+    version = 1
+
+    def __init__(self, git_root=None):
+        self.git_root = Path(git_root or get_git_root())
+        self.path = state_path(self.git_root, 'depcache.json')
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.entries = dict()
+        try:
+            with open(self.path, 'rt') as f:
+                saved = json.load(f)
+            if saved.get('version') == self.version:
+                self.entries = saved['tasks']
+        except (OSError, ValueError, KeyError):
+            self.entries = dict()
+
+    def _key(self, task):
+        return os.path.relpath(task, self.git_root)
+
+    def _abs(self, rel):
+        return str(Path(os.path.normpath(self.git_root / rel)))
+
+    def _makefiles_ok(self, task, entry):
+        for mk, (mtime, size, sha) in entry['makefiles'].items():
+            fname = Path(task) / mk
+            try:
+                st = os.stat(fname)
+            except OSError:
+                return False
+            if (st.st_mtime_ns, st.st_size) == (mtime, size):
+                continue
+            fingerprint = file_fingerprint(fname)
+            if fingerprint[2] != sha:
+                return False
+            entry['makefiles'][mk] = fingerprint
+            self.dirty = True
+        return True
+
+    def _links_ok(self, task, entry):
+        for dep, target in entry['links'].items():
+            try:
+                if os.readlink(Path(task) / dep) != target:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def lookup(self, task):
+        ''' (deps, tasks) for task, or None if missing or stale '''
+        with self.lock:
+            return self._lookup(task)
+
+    def _lookup(self, task):
+        entry = self.entries.get(self._key(task))
+        if entry is None:
+            return None
+        if (makefile_for(task) != entry['makefile'] or
+                not self._makefiles_ok(task, entry) or
+                not self._links_ok(task, entry)):
+            del self.entries[self._key(task)]
+            self.dirty = True
+            return None
+        return entry['deps'], [self._abs(t) for t in entry['tasks']]
+
+    def store(self, task, deps, tasks, makefiles):
+        links = dict()
+        for dep in deps:
+            if Path(task).joinpath(dep).is_symlink():
+                links[dep] = os.readlink(Path(task) / dep)
+        entry = {
+            'makefile': makefile_for(task),
+            'makefiles': {mk: file_fingerprint(Path(task) / mk)
+                          for mk in makefiles},
+            'links': links,
+            'deps': deps,
+            'tasks': [self._key(t) for t in tasks]}
+        with self.lock:
+            self.entries[self._key(task)] = entry
+            self.dirty = True
 
-    return str(tpath)
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp, 'wt') as f:
+                json.dump({'version': self.version, 'tasks': self.entries}, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
 
 
-def exec_make(make_args):
-    ''' in cwd, either `make` or `make --makefile src/Makefile` '''
+class Jobserver:
+    ''' a GNU make jobserver with jobs slots: a pipe holding jobs - 1
+        tokens, plus the one slot makr holds itself.  while one is active
+        (in a with block), exec_make, and build_task or an Engine for a
+        task with MAKR_CPUS > 1, give make MAKEFLAGS naming the pipe, so
+        `make -j` inside those tasks and makr's own tasks draw on one pool
+        of jobs slots.  other tasks' makes run serially, in their one slot.
+    '''
+    active = None
+
+    def __init__(self, jobs):
+        self.jobs = max(1, int(jobs))
+        self.read, self.write = os.pipe()
+        os.write(self.write, b'+' * (self.jobs - 1))
+        # we read tokens through a second, nonblocking open of the pipe, so
+        # the end the makes share stays blocking
+        try:
+            self.poll = os.open(f'/proc/self/fd/{self.read}',
+                                os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            self.poll = None
+        self.lock = threading.Lock()
+        self.free = True                # makr's own slot
+        self.cancelled = False
+
+    def __enter__(self):
+        Jobserver.active = self
+        return self
+
+    def __exit__(self, *exc):
+        Jobserver.active = None
+        for fd in (self.read, self.write, self.poll):
+            if fd is not None:
+                os.close(fd)
+
+    def makeflags(self, share=True):
+        ''' MAKEFLAGS from the environment, with our -j and pipe instead of
+            any it had, or (not share) with neither '''
+        keep = [w for w in os.environ.get('MAKEFLAGS', '').split()
+                if not w.startswith(('-j', '--jobserver'))]
+        if share:
+            keep.extend([f'-j{self.jobs}',
+                         f'--jobserver-auth={self.read},{self.write}'])
+        return ' '.join(keep)
+
+    def acquire(self):
+        ''' wait for a slot; return the token to give back to release() '''
+        while not self.cancelled:
+            with self.lock:
+                if self.free:
+                    self.free = False
+                    return None
+            fd = self.read if self.poll is None else self.poll
+            ready, _, _ = select.select([fd], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                token = os.read(fd, 1)
+            except BlockingIOError:
+                continue
+            if token:
+                return token
+        raise RuntimeError("jobserver cancelled")
+
+    def release(self, token):
+        if token is None:
+            with self.lock:
+                self.free = True
+        else:
+            os.write(self.write, token)
+
+    def cancel(self):
+        ''' stop waiting for slots; acquire() raises from now on '''
+        self.cancelled = True
+
+    def holding(self, build):
+        ''' build, holding a slot while each task runs '''
+        def held(task):
+            token = self.acquire()
+            try:
+                return build(task)
+            finally:
+                self.release(token)
+        return held
+
+
+def make_kwargs(task=None):
+    ''' extra Popen arguments for a make: the active jobserver's
+        MAKEFLAGS and pipe, if there is one.  a make in task gets them
+        only if the task asks for more than one cpu; many makefiles aren't
+        safe under -j (a rule with several targets runs its recipe once
+        per target at once), so the rest run serially '''
+    jobserver = Jobserver.active
+    if jobserver is None:
+        return dict()
+    if task is not None and task_needs(task).cpus <= 1:
+        return {'env': dict(os.environ,
+                            MAKEFLAGS=jobserver.makeflags(share=False))}
+    return {'env': dict(os.environ, MAKEFLAGS=jobserver.makeflags()),
+            'pass_fds': (jobserver.read, jobserver.write)}
+
+
+def make_command(make_args, cwd):
+    ''' make_args, plus `--makefile src/Makefile` if that's where it is '''
+    make_args = list(make_args)
     assert make_args[0] == 'make'
-    if Path('src/Makefile').exists():
+    cwd = Path(cwd)
+    if cwd.joinpath('src/Makefile').exists():
         make_args.extend(["--makefile", "src/Makefile"])
-    elif not Path('Makefile').exists():
-        raise FileNotFoundError(f"Makefile not found in {Path.cwd()}")
+    elif not cwd.joinpath('Makefile').exists():
+        raise FileNotFoundError(f"Makefile not found in {cwd}")
+    return make_args
+
+
+def exec_make(make_args, cwd=None):
+    ''' in cwd (default: the process cwd),
+        either `make` or `make --makefile src/Makefile`.
+        a build (not a --print-data-base) that fails raises
+        CalledProcessError with make's returncode '''
+    cwd = Path(cwd or Path.cwd())
+    make_args = make_command(make_args, cwd)
     if '--print-data-base' in make_args:
-        prox = subprocess.run(make_args, capture_output=True)
+        prox = subprocess.run(make_args, capture_output=True, cwd=cwd)
         make_stdout = prox.stdout.decode('utf-8')
         make_stderr = prox.stderr.decode('utf-8')
         rc = prox.returncode
         if rc in [1, 2]:
             print(f"make returns with {rc} --> {make_stderr}", file=sys.stderr)
     else:
-        prox = subprocess.Popen(make_args, shell=False, bufsize=1)
+        prox = subprocess.Popen(make_args, shell=False, bufsize=1, cwd=cwd,
+                                **make_kwargs())
         prox.communicate()
+        if prox.returncode != 0:
+            raise subprocess.CalledProcessError(prox.returncode, make_args)
         make_stdout = ''
     return make_stdout
 
 
-@preserve_cwd
-def get_deps_from_make(task_path, target=None):
-    ''' note: this outputs raw strings extracted from make output '''
-    os.chdir(task_path)
-    assert is_a_task('.')
-    db = exec_make(['make', '--dry-run', '--print-data-base'])
-    # note the re is used w match which assumes start of line
-    tofilter = re.compile(r'(\()*(%|#|make|\.|all|clean)')
-    white = re.compile(r'\s+')
-    deps = list()
-    for line in db.split(os.linesep):
-        if ': ' not in line:
+class MakeRule:
+    ''' one target's entry in make's database '''
+    __slots__ = ('target', 'prereqs', 'order_only', 'phony', 'pattern',
+                 'double_colon')
+
+    def __init__(self, target, prereqs=(), order_only=(), pattern=False,
+                 double_colon=False):
+        self.target = target
+        self.prereqs = list(prereqs)
+        self.order_only = list(order_only)
+        self.phony = False
+        self.pattern = pattern
+        self.double_colon = double_colon
+
+    def __repr__(self):
+        return (f"MakeRule({self.target!r}, {self.prereqs!r}, "
+                f"{self.order_only!r})")
+
+
+class MakeDatabase:
+    ''' the rules and makefile variables from `make --print-data-base`,
+        built up one line at a time by feed() so the text is never held
+        in memory.  rules maps each explicit target to its MakeRule,
+        patterns lists the implicit (pattern) rules, and variables holds
+        the variables that came from a makefile (unexpanded).
+    '''
+    header = re.compile(r'^(.*?[^\\])(::?)(?: (.*))?$')
+    assignment = re.compile(r'^(\S+) (:?:?=) ?(.*)$')
+    origins = ('# makefile', '# environment', '# default', '# automatic',
+               '# command line', '# override')
+    sections = {'# Variables': 'variables', '# Files': 'files',
+                '# Implicit Rules': 'implicit', '# Directories': 'other',
+                '# Pattern-specific Variable Values': 'other',
+                '# files hash-table stats:': 'other',
+                '# VPATH Search Paths': 'other'}
+
+    def __init__(self):
+        self.rules = dict()
+        self.patterns = list()
+        self.variables = dict()
+        self._section = None
+        self._entry = None
+        self._not_target = False
+        self._origin = None
+        self._define = False
+
+    @classmethod
+    def parse(cls, lines):
+        db = cls()
+        for line in lines:
+            db.feed(line)
+        return db
+
+    def feed(self, line):
+        line = line.rstrip('\n')
+        if line in self.sections:
+            self._section = self.sections[line]
+            self._entry = None
+            return
+        if self._section == 'variables':
+            self._feed_variable(line)
+        elif self._section in ('files', 'implicit'):
+            self._feed_rule(line)
+
+    def _feed_variable(self, line):
+        if self._define:
+            self._define = line != 'endef'
+        elif line.startswith('define '):
+            self._define = True
+        elif line.startswith('#'):
+            self._origin = line
+        elif self._origin and self._origin.startswith('# makefile'):
+            match = self.assignment.match(line)
+            if match:
+                self.variables[match.group(1)] = match.group(3)
+            self._origin = None
+
+    def _feed_rule(self, line):
+        if not line:
+            self._entry = None
+            self._not_target = False
+            self._origin = None
+        elif line.startswith('\t'):
+            return                          # recipe
+        elif line.startswith('#'):
+            if line == '# Not a target:':
+                self._not_target = True
+            elif line.startswith(self.origins):
+                self._origin = line
+            elif self._entry and line.startswith('#  Phony target'):
+                self._entry.phony = True
+        elif self._origin:
+            self._origin = None             # target-specific variable
+        elif self._entry is None:
+            self._entry = self._start_rule(line)
+
+    def _start_rule(self, line):
+        match = self.header.match(line)
+        if not match:
+            return None
+        target, colons, rest = match.groups()
+        normal, _, order_only = (rest or '').partition(' | ')
+        if normal.startswith('| '):
+            normal, order_only = '', normal[2:]
+        rule = MakeRule(target, normal.split(), order_only.split(),
+                        pattern=self._section == 'implicit',
+                        double_colon=colons == '::')
+        if rule.pattern:
+            self.patterns.append(rule)
+        elif not self._not_target:
+            self.rules[target] = rule
+        return rule
+
+    @property
+    def makefiles(self):
+        ''' the makefiles make read, as listed in MAKEFILE_LIST '''
+        return self.variables.get('MAKEFILE_LIST', '').split()
+
+    @property
+    def phony(self):
+        return set(t for t, r in self.rules.items() if r.phony)
+
+    def file_rules(self):
+        ''' explicit rules for real files: not phony, not special targets
+            like .PHONY, and not the conventional all and clean '''
+        return [r for t, r in self.rules.items()
+                if not (r.phony or t.startswith('.') or t in ('all', 'clean'))]
+
+    def deps(self, target=None):
+        ''' sorted prereqs (normal and order-only) of target, or of every
+            file rule if target is None '''
+        if target:
+            rule = self.rules.get(target)
+            if rule is None:
+                errmsg = (f"target={target} not found in make rules "
+                          f"{sorted(self.rules)}")
+                raise RuntimeError(errmsg)
+            rules = [rule]
+        else:
+            rules = self.file_rules()
+        return sorted(set(d for r in rules for d in r.prereqs + r.order_only))
+
+
+def read_make_db(task_path):
+    ''' in task_path, run make to print its database, and parse make's
+        stdout as it arrives.  return a MakeDatabase '''
+    task_path = Path(task_path).resolve()
+    assert is_a_task(task_path)
+    make_args = make_command(['make', '--dry-run', '--print-data-base'],
+                             task_path)
+    db = MakeDatabase()
+    with tempfile.TemporaryFile() as errs:
+        prox = subprocess.Popen(make_args, cwd=task_path, stderr=errs,
+                                stdout=subprocess.PIPE,
+                                encoding='utf-8', errors='replace')
+        with prox.stdout:
+            for line in prox.stdout:
+                db.feed(line)
+        rc = prox.wait()
+        if rc in [1, 2]:
+            errs.seek(0)
+            make_stderr = errs.read().decode('utf-8', errors='replace')
+            print(f"make returns with {rc} --> {make_stderr}", file=sys.stderr)
+    return db
+
+
+def read_makefile(task_path):
+    ''' read a simple PDP makefile in-process instead of running make:
+        explicit rules, backslash continuations, .PHONY, comments and plain
+        variable assignments.  return a MakeDatabase, or None when the
+        makefile uses anything else (includes, conditionals, functions or
+        variables in rules, pattern, double-colon or grouped (&:) rules,
+        target-specific variables...) and make has to be asked.
+        note that make can add prereqs found by implicit rule search;
+        verify_reader compares the two across a repository.
+    '''
+    task_path = Path(task_path)
+    makefile = makefile_for(task_path)
+    if makefile is None or os.environ.get('MAKEFILES'):
+        return None
+    if makefile == 'Makefile' and any(
+            task_path.joinpath(mk).exists()
+            for mk in ('GNUmakefile', 'makefile')):
+        return None
+    with open(task_path / makefile, 'rt') as f:
+        text = f.read()
+    db = MakeDatabase()
+    db.variables['MAKEFILE_LIST'] = makefile
+    unsupported = re.compile(
+        r'^(-?include|sinclude|ifn?eq|ifn?def|else|endif|define|endef|'
+        r'override|export|unexport|vpath|undefine|private|load)\b')
+    phony = set()
+    in_recipe = False
+    continued = False
+    logical = ''
+    for line in text.split('\n'):
+        if continued and in_recipe:         # recipe continuation
+            continued = line.endswith('\\')
             continue
-        elif tofilter.match(line):
+        if line.startswith('\t') and in_recipe and not logical:
+            continued = line.endswith('\\')
             continue
-        elif target and not line.startswith(target):
+        if line.endswith('\\'):
+            logical += line[:-1] + ' '
             continue
-        line = line.split(":", maxsplit=1)[1]
-        deps.extend([d.strip() for d in white.split(line)])
-        if target:
-            break
-    else:
-        if target:
-            errmsg = f"target={target} not found in make rules {deps}"
-            raise RuntimeError(errmsg)
-    # remove empty strings & dups, return sorted list
-    return sorted(set(filter(None, deps)))
+        line = logical + line
+        logical = ''
+        if '\\#' in line:
+            return None
+        line = line.split('#', 1)[0].rstrip()
+        if not line.strip():
+            continue
+        if unsupported.match(line.strip()):
+            return None
+        if line.startswith('\t'):
+            return None                     # recipe with no rule
+        if '$' in line.split('=', 1)[0] or ';' in line:
+            return None
+        match = re.match(r'^\s*([\w.]+)\s*(\?|\+|!|::?)?=\s*(.*)$', line)
+        if match:
+            if match.group(2) in ('?', '+', '!'):
+                return None
+            db.variables[match.group(1)] = match.group(3)
+            in_recipe = False
+            continue
+        targets, colon, rest = line.partition(':')
+        if not colon or '$' in rest or '%' in line or '=' in rest \
+                or rest.startswith(':') or targets.rstrip().endswith('&'):
+            return None
+        normal, _, order_only = rest.partition('|')
+        for target in targets.split():
+            if target == '.PHONY':
+                phony.update(normal.split())
+            rule = db.rules.get(target)
+            if rule is None:
+                rule = db.rules[target] = MakeRule(target)
+            rule.prereqs.extend(p for p in normal.split()
+                                if p not in rule.prereqs)
+            rule.order_only.extend(p for p in order_only.split()
+                                   if p not in rule.order_only)
+        in_recipe = True
+    for target in phony:
+        if target not in db.rules:
+            db.rules[target] = MakeRule(target)
+        db.rules[target].phony = True
+    return db
+
+
+def load_make_db(task_path, fast=True):
+    ''' a task's MakeDatabase, from read_makefile if fast and the makefile
+        allows it, otherwise from make.  return (db, ran_make) '''
+    db = read_makefile(task_path) if fast else None
+    if db is not None:
+        return db, False
+    return read_make_db(task_path), True
+
+
+def scan_dir(dirpath):
+    ''' one directory of find_tasks: (dirpath, whether it is a task, the
+        subdirectories to scan next).  like is_a_task, a leaf may be a
+        symlink to a directory; like os.walk, other symlinks aren't followed
+    '''
+    subdirs = list()
+    task = False
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    if entry.name in TASK_LEAVES and entry.is_dir():
+                        task = True
+                        continue
+                    if entry.name != '.git' and \
+                            entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return dirpath, task, subdirs
+
+
+def find_tasks(root, jobs=8):
+    ''' every task under root, sorted, skipping .git and the insides of
+        tasks' leaf directories.  up to jobs directories are read at once '''
+    tasks = list()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        running = {pool.submit(scan_dir, str(Path(root).resolve()))}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath, task, subdirs = future.result()
+                if task:
+                    tasks.append(dirpath)
+                running.update(pool.submit(scan_dir, d) for d in subdirs)
+    return sorted(tasks)
+
+
+def verify_reader(root):
+    ''' compare read_makefile with make's database for every task under
+        root.  return (task, status, detail) for each task, where status is
+        'ok', 'fallback' (read_makefile declined), 'nomake' (no makefile)
+        or 'differs', with detail giving make's and the reader's prereqs
+        for each target that disagrees
+    '''
+    report = list()
+    for task in find_tasks(root):
+        if makefile_for(task) is None:
+            report.append((task, 'nomake', None))
+            continue
+        fast = read_makefile(task)
+        if fast is None:
+            report.append((task, 'fallback', None))
+            continue
+        slow = read_make_db(task)
+        targets = set(r.target for r in fast.file_rules()) | \
+            set(r.target for r in slow.file_rules())
+        detail = dict()
+        for target in sorted(targets):
+            ours = fast.deps(target) if target in fast.rules else None
+            theirs = slow.deps(target) if target in slow.rules else None
+            if ours != theirs:
+                detail[target] = (theirs, ours)
+        if fast.deps() != slow.deps():
+            detail[None] = (slow.deps(), fast.deps())
+        report.append((task, 'differs' if detail else 'ok', detail or None))
+    return report
+
+
+def get_deps_from_make(task_path, target=None):
+    ''' note: this outputs raw strings extracted from make output '''
+    return read_make_db(task_path).deps(target=target)
+
+
+def target_deps(db, task, targets=None, resolver=None):
+    ''' {target: {'prereqs': sorted prereqs, 'tasks': {prereq: the upstream
+        task it resolves to, or None if it is in task or in no task}}} for
+        each of targets, or for every explicit target but the special ones
+        (like .PHONY) if targets is None, all from one MakeDatabase '''
+    task = Path(task).resolve()
+    resolver = resolver or TaskResolver(cwd=task)
+    if targets is None:
+        targets = sorted(t for t in db.rules if not t.startswith('.'))
+    out = dict()
+    for target in targets:
+        prereqs = db.deps(target=target)
+        tasks = dict()
+        for prereq in prereqs:
+            try:
+                upstream = resolver.task_path(prereq, base=task)
+            except OSError:
+                upstream = None
+            tasks[prereq] = None if upstream == str(task) else upstream
+        out[target] = {'prereqs': prereqs, 'tasks': tasks}
+    return out
+
+
+def query_targets(tasks, targets=None, jobs=8, fast=True, errors=None,
+                  query=None):
+    ''' {task: target_deps} for several tasks, up to jobs at once, each
+        from a single read of its makefile.  query(task, targets), e.g.
+        from a daemon, is tried first and its answer used unless it is
+        None.  if errors is a dict, tasks that couldn't be answered are put
+        in it with the reason instead of raising '''
+    tasks = [str(Path(t).resolve()) for t in tasks]
+    resolver = TaskResolver(cwd=tasks[0]) if tasks else None
+
+    def answer(task):
+        found = query(task, targets) if query else None
+        if found is not None:
+            return found
+        if makefile_for(task) is None:
+            errmsg = f"no Makefile in {task}"
+            raise OSError(errmsg)
+        db, _ = load_make_db(task, fast=fast)
+        return target_deps(db, task, targets, resolver=resolver)
+
+    out = dict()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {task: pool.submit(answer, task) for task in tasks}
+        for task, future in futures.items():
+            try:
+                out[task] = future.result()
+            except (OSError, RuntimeError) as err:
+                if errors is None:
+                    raise
+                errors[task] = str(err)
+    return out
 
 
-@preserve_cwd
-def get_tasks_from_deps(base_task, deps):
+def get_tasks_from_deps(base_task, deps, resolver=None):
     ''' given dep,
         return project-root abs task path
     '''
     base_task = Path(base_task).resolve()
-    os.chdir(base_task)
-    tasks = [get_task_path(d) for d in deps]
+    resolver = resolver or TaskResolver(cwd=base_task)
+    tasks = [resolver.task_path(d, base=base_task) for d in deps]
     return sorted(set([t for t in tasks if t != str(base_task)]))
 
 
-@preserve_cwd
+def count_paths(pairs, base_task):
+    ''' number of distinct paths from each task down to base_task,
+        i.e. how many times the naive recursion would query it '''
+    downstream = dict()
+    for prereq, task in pairs:
+        downstream.setdefault(prereq, set()).add(task)
+    npaths = {base_task: 1}
+    stack = list(downstream)
+    while stack:
+        task = stack[-1]
+        if task in npaths:
+            stack.pop()
+            continue
+        todo = [t for t in downstream[task] if t not in npaths]
+        if todo:
+            stack.extend(todo)
+        else:
+            npaths[task] = sum(npaths[t] for t in downstream[task])
+            stack.pop()
+    return npaths
+
+
+def query_task(task, cache=None, resolver=None, fast=True):
+    ''' return a task's raw prereqs and the upstream tasks they resolve to,
+        and where they came from: 'cache', 'reader' or 'make' '''
+    if cache is not None:
+        hit = cache.lookup(task)
+        if hit is not None:
+            return hit[0], hit[1], 'cache'
+    db, ran_make = load_make_db(task, fast=fast)
+    deps = db.deps()
+    tasks = get_tasks_from_deps(task, deps, resolver=resolver)
+    if cache is not None:
+        cache.store(task, deps, tasks, db.makefiles)
+    return deps, tasks, 'make' if ran_make else 'reader'
+
+
+def discover_graph(base_task, stats=None, cache=None, jobs=1, fast=True):
+    ''' walk the upstream graph once, querying make at most once per task
+        return pairs (prereq, task) like follow_deps
+        if stats is a dict, fill in the number of tasks read from make
+        ('queried'), by read_makefile ('read') and from the cache
+        ('cached'), and the task queries saved over a path-by-path walk
+        if cache is a DepCache, only tasks with changed makefiles are read
+        if fast, simple makefiles are read without running make
+        up to jobs tasks are queried at once, each as soon as it is found
+    '''
+    resolver = TaskResolver(cwd=Path(base_task).resolve())
+    base_task = resolver.task_path(base_task)
+    pairs = set()
+    seen = {base_task}
+    sources = {'make': 0, 'reader': 0, 'cache': 0}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        running = {pool.submit(query_task, base_task, cache, resolver, fast):
+                   base_task}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                deps, tasks, source = future.result()
+                sources[source] += 1
+                for prereq in tasks:
+                    pairs.add((prereq, task))
+                    if prereq not in seen:
+                        seen.add(prereq)
+                        future = pool.submit(query_task, prereq, cache,
+                                             resolver, fast)
+                        running[future] = prereq
+    if cache is not None:
+        cache.save()
+    if stats is not None:
+        naive = sum(count_paths(pairs, base_task).values())
+        stats['queried'] = sources['make']
+        stats['read'] = sources['reader']
+        stats['cached'] = sources['cache']
+        stats['saved'] = naive - len(seen)
+    return sorted(pairs)
+
+
+def check_cache(base_task, cache):
+    ''' compare cached entries for base_task's graph with live make output
+        return a list of (task, cached, live) for every disagreement
+    '''
+    mismatches = list()
+    resolver = TaskResolver(git_root=cache.git_root)
+    for task in graph_tasks(discover_graph(base_task, cache=cache),
+                            resolver.task_path(Path(base_task).resolve())):
+        hit = cache.lookup(task)
+        deps = get_deps_from_make(task)
+        live = (deps, get_tasks_from_deps(task, deps, resolver=resolver))
+        if hit is None or tuple(hit) != live:
+            mismatches.append((task, hit, live))
+    return mismatches
+
+
+def graph_tasks(pairs, base_task):
+    ''' every task in a graph, including a base_task with no prereqs '''
+    return sorted(set(t for pair in pairs for t in pair) | {base_task})
+
+
 def follow_deps(base_task):
     ''' follow a task's dependencies recursively to the first files
         return pairs (prereq, task)
     '''
-    base_task = Path(base_task).resolve()
-    deps = get_deps_from_make(base_task)
-    tasks = get_tasks_from_deps(base_task, deps)
-    base_task = get_task_path(base_task)
-    pairs = [(t, base_task) for t in tasks]
-    for task in tasks:
-        pairs.extend(follow_deps(task))
-    return sorted(set(pairs))
+    return discover_graph(base_task)
+
+
+class CycleError(RuntimeError):
+    ''' tasks that depend on each other, so can't be ordered.
+        cycles is a list of (tasks, edges), one per strongly connected
+        component of the graph.
+    '''
+    def __init__(self, cycles):
+        self.cycles = cycles
+        descr = '; '.join(' <-> '.join(str(t) for t in tasks)
+                          for tasks, edges in cycles)
+        errmsg = ("Cycle found in upstream task dependency network. "
+                  f"run -L can't tell which task should be run first: {descr}")
+        super().__init__(errmsg)
+
+
+class TaskGraph:
+    ''' tasks and their (prereq, task) edges, indexed in both directions.
+        dicts are used as ordered sets so that orderings are repeatable.
+    '''
+    def __init__(self, pairs=(), tasks=()):
+        self.upstream = dict()
+        self.downstream = dict()
+        for task in tasks:
+            self.add_task(task)
+        for prereq, task in pairs:
+            self.add_edge(prereq, task)
+
+    def add_task(self, task):
+        if task not in self.upstream:
+            self.upstream[task] = dict()
+            self.downstream[task] = dict()
+
+    def add_edge(self, prereq, task):
+        self.add_task(prereq)
+        self.add_task(task)
+        self.upstream[task][prereq] = None
+        self.downstream[prereq][task] = None
+
+    def set_upstream(self, task, prereqs):
+        ''' replace the edges into task with edges from prereqs '''
+        self.add_task(task)
+        for prereq in self.upstream[task]:
+            del self.downstream[prereq][task]
+        self.upstream[task] = dict()
+        for prereq in prereqs:
+            self.add_edge(prereq, task)
+
+    @property
+    def tasks(self):
+        return list(self.upstream)
+
+    def pairs(self):
+        return sorted((p, t) for t in self.upstream for p in self.upstream[t])
+
+    def __len__(self):
+        return len(self.upstream)
+
+    def __contains__(self, task):
+        return task in self.upstream
+
+    def levels(self):
+        ''' Kahn's algorithm: lists of tasks, each of which depends only on
+            tasks in earlier lists.  raises CycleError. '''
+        waiting = {t: len(ups) for t, ups in self.upstream.items()}
+        level = [t for t, n in waiting.items() if n == 0]
+        levels = list()
+        nsorted = 0
+        while level:
+            levels.append(level)
+            nsorted += len(level)
+            nxt = list()
+            for task in level:
+                for down in self.downstream[task]:
+                    waiting[down] -= 1
+                    if waiting[down] == 0:
+                        nxt.append(down)
+            level = nxt
+        if nsorted < len(self.upstream):
+            raise CycleError(self.cycles())
+        return levels
+
+    def order(self):
+        ''' every task, after all of its prereqs '''
+        return [t for level in self.levels() for t in level]
+
+    def cycles(self):
+        ''' Tarjan's strongly connected components, iteratively.
+            return (tasks, edges) for each component that has a cycle '''
+        index = dict()
+        lowlink = dict()
+        stack = list()
+        onstack = set()
+        found = list()
+        for root in self.upstream:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            onstack.add(root)
+            work = [(root, iter(self.downstream[root]))]
+            while work:
+                task, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        onstack.add(child)
+                        work.append((child, iter(self.downstream[child])))
+                        break
+                    elif child in onstack:
+                        lowlink[task] = min(lowlink[task], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[task])
+                    if lowlink[task] == index[task]:
+                        component = list()
+                        while True:
+                            member = stack.pop()
+                            onstack.discard(member)
+                            component.append(member)
+                            if member == task:
+                                break
+                        found.append(component[::-1])
+        cycles = list()
+        for component in found:
+            members = set(component)
+            edges = [(p, t) for t in component for p in self.upstream[t]
+                     if p in members]
+            if edges:
+                cycles.append((component, edges))
+        return cycles
+
+    def upstream_of(self, tasks):
+        ''' tasks, and everything they depend on '''
+        return self._closure(tasks, self.upstream)
+
+    def downstream_of(self, tasks):
+        ''' tasks, and everything that depends on them '''
+        return self._closure(tasks, self.downstream)
+
+    def subgraph(self, tasks):
+        ''' the graph restricted to tasks, keeping the edges between them '''
+        tasks = set(tasks)
+        sub = TaskGraph(tasks=[t for t in self.upstream if t in tasks])
+        for task in sub.upstream:
+            for prereq in self.upstream[task]:
+                if prereq in tasks:
+                    sub.add_edge(prereq, task)
+        return sub
+
+    def _closure(self, tasks, edges):
+        seen = set(tasks)
+        todo = list(seen)
+        while todo:
+            for nxt in edges[todo.pop()]:
+                if nxt not in seen:
+                    seen.add(nxt)
+                    todo.append(nxt)
+        return seen
+
+
+def index_repo(root, jobs=8, cache=None, fast=True, errors=None):
+    ''' the graph of every task under root and every edge into them, not
+        just those upstream of one task.  a task without a makefile has no
+        edges in; if errors is a dict, tasks whose prereqs couldn't be read
+        are put in it with the reason instead of raising '''
+    tasks = find_tasks(root, jobs=jobs)
+    graph = TaskGraph(tasks=tasks)
+    resolver = TaskResolver(cwd=root)
+    todo = [t for t in tasks if makefile_for(t) is not None]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {pool.submit(query_task, task, cache, resolver, fast): task
+                   for task in todo}
+        for future, task in futures.items():
+            try:
+                _, prereqs, _ = future.result()
+            except (OSError, RuntimeError) as err:
+                if errors is None:
+                    raise
+                errors[task] = str(err)
+                continue
+            for prereq in prereqs:
+                graph.add_edge(prereq, task)
+    if cache is not None:
+        cache.save()
+    return graph
+
+
+def graph_json(graph, root):
+    ''' the graph as a json-ready dict, with paths relative to root '''
+    rel = functools.partial(os.path.relpath, start=root)
+    return {'root': str(root),
+            'tasks': sorted(rel(t) for t in graph.tasks),
+            'edges': sorted([rel(a), rel(b)] for a, b in graph.pairs())}
+
+
+def graph_dot(graph, root):
+    ''' the graph in graphviz's dot language, with paths relative to root '''
+    rel = functools.partial(os.path.relpath, start=root)
+    lines = ['digraph makr {', '    rankdir=LR;']
+    lines.extend(f'    "{rel(t)}";' for t in sorted(graph.tasks))
+    lines.extend(f'    "{rel(a)}" -> "{rel(b)}";'
+                 for a, b in sorted(graph.pairs()))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
 
 
 def topological_sort(deps):
@@ -161,44 +1101,711 @@ def topological_sort(deps):
         and returns a sequence of items such that no item in the
         sequence depends on an earlier item.
     """
-    def prereqs_of(task):
-        ''' return all prereqs for task '''
-        return set([p for (p, t) in deps if t == task])
+    return TaskGraph(deps).order()
+
+
+class HashState:
+    ''' content hashes of each task's inputs (all prereqs) and outputs (its
+        file targets) as of its last successful build, kept in
+        git_root/.makr/hashes.json.  files are only re-hashed when their
+        (mtime, size, inode) signature has moved since they were last hashed.
+    '''
+    version = 1
+
+    def __init__(self, git_root=None):
+        self.git_root = Path(git_root or get_git_root())
+        self.path = state_path(self.git_root, 'hashes.json')
+        self.lock = threading.Lock()
+        self.tasks = dict()
+        self.files = dict()                 # abs path -> [sig, sha1]
+        try:
+            with open(self.path, 'rt') as f:
+                saved = json.load(f)
+            if saved.get('version') == self.version:
+                self.tasks, self.files = saved['tasks'], saved['files']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def file_hash(self, fname):
+        ''' sha1 of fname, or None if it doesn't exist '''
+        fname = str(Path(fname).resolve())
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        sig = [st.st_mtime_ns, st.st_size, st.st_ino]
+        known = self.files.get(fname)
+        if known and known[0] == sig:
+            return known[1]
+        sha = hash_file(fname)
+        with self.lock:
+            self.files[fname] = [sig, sha]
+        return sha
+
+    def snapshot(self, task):
+        ''' {'inputs': {prereq: sha1}, 'outputs': {target: sha1}} '''
+        db, _ = load_make_db(task)
+        return {
+            'inputs': {d: self.file_hash(Path(task) / d) for d in db.deps()},
+            'outputs': {r.target: self.file_hash(Path(task) / r.target)
+                        for r in db.file_rules()}}
+
+    def is_clean(self, task):
+        ''' True if task's inputs and outputs have the same contents as
+            after its last recorded build, whatever their mtimes '''
+        recorded = self.tasks.get(os.path.relpath(task, self.git_root))
+        if recorded is None:
+            return False
+        current = self.snapshot(task)
+        return (current == recorded and
+                None not in current['outputs'].values())
+
+    def record(self, task):
+        snapshot = self.snapshot(task)
+        with self.lock:
+            self.tasks[os.path.relpath(task, self.git_root)] = snapshot
+
+    def has(self, task):
+        return os.path.relpath(task, self.git_root) in self.tasks
+
+    def settle(self, task):
+        ''' touch a clean task's outputs so make agrees it is up to date,
+            keeping their recorded hashes '''
+        db, _ = load_make_db(task)
+        for rule in db.file_rules():
+            fname = Path(task).joinpath(rule.target).resolve()
+            sha = self.file_hash(fname)
+            os.utime(fname)
+            st = os.stat(fname)
+            with self.lock:
+                self.files[str(fname)] = [
+                    [st.st_mtime_ns, st.st_size, st.st_ino], sha]
+
+    def save(self):
+        with self.lock:
+            tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp, 'wt') as f:
+                json.dump({'version': self.version, 'tasks': self.tasks,
+                           'files': self.files}, f)
+            os.replace(tmp, self.path)
+
+
+TaskResult = namedtuple('TaskResult',
+                        'task returncode elapsed note start usage',
+                        defaults=(None, None, None))
+
+
+def exit_code(status):
+    ''' a wait() status as a returncode, negative for a signal '''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def rusage_dict(rusage):
+    ''' the parts of a child's rusage that makr reports.  read_bytes and
+        write_bytes count blocks that actually went to or from storage
+        (not the page cache), as the kernel accounts them.  maxrss is the
+        peak resident memory of the largest single process, not of the
+        tree: a task running two 1 GB processes at once shows 1 GB. '''
+    return {'utime': rusage.ru_utime, 'stime': rusage.ru_stime,
+            'maxrss': rusage.ru_maxrss * 1024,
+            'read_bytes': rusage.ru_inblock * 512,
+            'write_bytes': rusage.ru_oublock * 512}
+
+
+def build_task(task):
+    ''' run make in task, return a TaskResult.  make is reaped with wait4,
+        so usage covers make and every process it waited for '''
+    start = time.time()
+    prox = subprocess.Popen(make_command(['make'], task), cwd=task,
+                            **make_kwargs(task))
+    _, status, rusage = os.wait4(prox.pid, 0)
+    prox.returncode = exit_code(status)
+    return TaskResult(task, prox.returncode, time.time() - start,
+                      start=start, usage=rusage_dict(rusage))
+
+
+def build_task_hashed(task, hashes, build=build_task):
+    ''' skip task if its inputs' contents haven't changed since its last
+        build (touching its outputs instead); otherwise build it and record
+        the new hashes '''
+    start = time.time()
+    if hashes.is_clean(task):
+        hashes.settle(task)
+        return TaskResult(task, 0, time.time() - start, 'unchanged',
+                          start=start)
+    result = build(task)
+    if result.returncode == 0:
+        hashes.record(task)
+    return result
+
+
+class ReadyQueue:
+    ''' tasks whose prereqs are done, highest priority first, then in the
+        order they became ready '''
+    def __init__(self, priority=None):
+        self.priority = priority or dict()
+        self.heap = list()
+        self.count = 0
+
+    def push(self, task):
+        heapq.heappush(self.heap,
+                       (-self.priority.get(task, 0), self.count, task))
+        self.count += 1
+
+    def pop(self, fits=None):
+        ''' the first task, or with fits, the first task for which fits(task)
+            is true, or None if there is none '''
+        if fits is None:
+            return heapq.heappop(self.heap)[2]
+        skipped = list()
+        task = None
+        while self.heap:
+            item = heapq.heappop(self.heap)
+            if fits(item[2]):
+                task = item[2]
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(self.heap, item)
+        return task
 
-    tasks_with_prereqs = set([t for p, t in deps])
+    def __len__(self):
+        return len(self.heap)
 
-    all_tasks = tasks_with_prereqs | set(p for p, t in deps)
 
-    tasks_without_prereqs = all_tasks - tasks_with_prereqs
-    sorted_tasks = list(tasks_without_prereqs)
+Resources = namedtuple('Resources', 'cpus mem')
+RESOURCE_FILE = 'makr.conf'
+SIZES = {'': 1 << 20, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
 
-    while len(sorted_tasks) < len(all_tasks):
-        unsorted_tasks = all_tasks - set(sorted_tasks)
 
-        one_step_downstream_tasks = set([
-            t for t in unsorted_tasks
-            if prereqs_of(t) <= set(sorted_tasks)])
+def parse_size(text):
+    ''' bytes in a size like 512M, 16G or 1.5T; a bare number is in MB '''
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)B?\s*$', str(text),
+                     re.IGNORECASE)
+    if not match:
+        errmsg = f"can't read {text!r} as a size like 512M or 16G"
+        raise ValueError(errmsg)
+    return int(float(match.group(1)) * SIZES[match.group(2).upper()])
 
-        next_tasks = list(one_step_downstream_tasks)
-        if not next_tasks:
-            errmsg = ("Cycle found in upstream task dependency network. "
-                      "run -L can't tell which task should be run first.")
-            raise RuntimeError(errmsg)
-            # find_and_print_cycle(deps)
-        sorted_tasks.extend(next_tasks)
 
-    return sorted_tasks
+def task_needs(task):
+    ''' the cpus and memory (bytes) task says it needs, as MAKR_CPUS and
+        MAKR_MEM lines in a makr.conf file next to its Makefile, or as
+        variables in the Makefile.  1 cpu and no memory if it doesn't say,
+        or says it in a way we can't read (like $(NCPU), unexpanded)
+    '''
+    found = dict()
+    makefile = makefile_for(task)
+    if makefile is not None:
+        conf = (Path(task) / makefile).parent / RESOURCE_FILE
+        if conf.exists():
+            for line in conf.read_text().splitlines():
+                name, _, value = line.partition('=')
+                if value and not name.strip().startswith('#'):
+                    found[name.strip()] = value.strip()
+        if not found:
+            db, _ = load_make_db(task)
+            found = db.variables
+    try:
+        cpus = float(found.get('MAKR_CPUS', 1))
+        mem = found.get('MAKR_MEM')
+        return Resources(cpus, 0 if mem is None else parse_size(mem))
+    except ValueError as err:
+        print(f"makr: {task}: can't read MAKR_CPUS or MAKR_MEM ({err}), "
+              f"taking 1 cpu", file=sys.stderr)
+        return Resources(1, 0)
+
+
+def plus(a, b, sign=1):
+    return Resources(a.cpus + sign * b.cpus, a.mem + sign * b.mem)
+
+
+def within(used, budget):
+    return all(limit is None or u <= limit for u, limit in zip(used, budget))
+
+
+def fit(need, budget):
+    ''' need, cut down to budget, so a task bigger than the machine can
+        still run (alone) '''
+    return Resources(
+        need.cpus if budget.cpus is None else min(need.cpus, budget.cpus),
+        need.mem if budget.mem is None else min(need.mem, budget.mem))
+
+
+class DurationHistory:
+    ''' the last few wall times of each task, in git_root/.makr/durations.json
+    '''
+    keep = 10
+
+    def __init__(self, git_root=None):
+        self.git_root = Path(git_root or get_git_root())
+        self.path = state_path(self.git_root, 'durations.json')
+        try:
+            with open(self.path, 'rt') as f:
+                self.durations = json.load(f)
+        except (OSError, ValueError):
+            self.durations = dict()
+
+    def estimate(self, task):
+        ''' median past duration of task; for a task never seen, the median
+            over all tasks, or 1s if there is no history at all '''
+        past = self.durations.get(os.path.relpath(task, self.git_root))
+        if not past:
+            past = [d for ds in self.durations.values() for d in ds] or [1.0]
+        return sorted(past)[len(past) // 2]
+
+    def add(self, task, seconds):
+        past = self.durations.setdefault(
+            os.path.relpath(task, self.git_root), list())
+        past.append(round(seconds, 3))
+        del past[:-self.keep]
+
+    def save(self):
+        tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'wt') as f:
+            json.dump(self.durations, f)
+        os.replace(tmp, self.path)
+
+
+def critical_path(graph, estimate):
+    ''' each task's priority is its own estimated duration plus the longest
+        estimated path downstream of it.  return (priorities, the longest
+        path in the graph, from its first task to its last) '''
+    priority = dict()
+    longest = dict()
+    for task in reversed(graph.order()):
+        nxt = max(graph.downstream[task], key=priority.get, default=None)
+        priority[task] = estimate(task) + priority.get(nxt, 0)
+        longest[task] = nxt
+    task = max(priority, key=priority.get, default=None)
+    path = list()
+    while task is not None:
+        path.append(task)
+        task = longest[task]
+    return priority, path
+
+
+def simulate(graph, estimate, jobs=1, priority=None):
+    ''' estimated wall time to run graph with jobs at once, scheduling the
+        way run_tasks does '''
+    waiting = {t: len(ups) for t, ups in graph.upstream.items()}
+    ready = ReadyQueue(priority)
+    for task in graph.levels()[0] if len(graph) else []:
+        ready.push(task)
+    running = list()                        # heap of (end, seq, task)
+    now = 0.0
+    seq = 0
+    while ready or running:
+        while ready and len(running) < jobs:
+            task = ready.pop()
+            heapq.heappush(running, (now + estimate(task), seq, task))
+            seq += 1
+        now, _, task = heapq.heappop(running)
+        for nxt in graph.downstream[task]:
+            waiting[nxt] -= 1
+            if waiting[nxt] == 0:
+                ready.push(nxt)
+    return now
+
+
+def run_tasks(graph, jobs=1, report=None, build=build_task, priority=None,
+              needs=None, budget=None, keep_going=False):
+    ''' run make in each task of a TaskGraph as soon as its prereqs have
+        finished, up to jobs at once.  after a failure no new task starts,
+        unless keep_going, when only the tasks downstream of it are left
+        out and everything else still runs.
+        build(task) runs one task and returns its TaskResult.
+        report(result) is called as each task finishes.
+        when several tasks are ready, those with the highest priority (a
+        dict, e.g. from critical_path) start first.
+        with a budget (Resources, either may be None for no limit), a task
+        only starts if its needs ({task: Resources}, 1 cpu by default) fit
+        in what the running tasks leave; the first ready task that fits
+        goes next.  raises RuntimeError if tasks are left ready with
+        nothing failed, e.g. with jobs < 1.
+        return TaskResults in the order the tasks finished
+    '''
+    waiting = {t: len(ups) for t, ups in graph.upstream.items()}
+    ready = ReadyQueue(priority)
+    for task in graph.levels()[0] if len(graph) else []:
+        ready.push(task)
+    results = list()
+    failed = False
+    budget = budget or Resources(None, None)
+    needs = {t: fit((needs or dict()).get(t, Resources(1, 0)), budget)
+             for t in graph.tasks}
+    used = Resources(0, 0)
+
+    def fits(task):
+        return within(plus(used, needs[task]), budget)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        running = dict()
+        while ready or running:
+            while ready and len(running) < jobs and not failed:
+                task = ready.pop(fits)
+                if task is None:
+                    break
+                used = plus(used, needs[task])
+                running[pool.submit(build, task)] = task
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                used = plus(used, needs[task], -1)
+                result = future.result()
+                results.append(result)
+                if report:
+                    report(result)
+                if result.returncode != 0:
+                    failed = not keep_going
+                    continue
+                for nxt in graph.downstream[task]:
+                    waiting[nxt] -= 1
+                    if waiting[nxt] == 0:
+                        ready.push(nxt)
+    if ready and not failed:
+        errmsg = (f"run_tasks: {len(ready)} tasks ready but none could "
+                  f"start (jobs={jobs}, budget={budget})")
+        raise RuntimeError(errmsg)
+    return results
+
+
+def print_result(result):
+    ''' one line per finished task on stderr '''
+    status = result.note or 'ok'
+    if result.returncode != 0:
+        status = f'FAILED rc={result.returncode}'
+        if result.note:
+            status = f'{status} ({result.note})'
+    print(f"makr: {status:>8} {result.elapsed:8.1f}s  {result.task}",
+          file=sys.stderr)
+
 
+def skipped_tasks(graph, results):
+    ''' {task in graph that didn't run: the failed tasks upstream of it,
+        or an empty list if it was only left waiting after a failure} '''
+    failed = {r.task for r in results if r.returncode != 0}
+    ran = {r.task for r in results}
+    return {task: sorted(failed & graph.upstream_of([task]))
+            for task in graph.order() if task not in ran}
 
-@preserve_cwd
-def make_all(base_task):
+
+def print_outcome(graph, results, file=sys.stderr):
+    ''' after a failure, each task that failed, was skipped or succeeded '''
+    failed = [r for r in results if r.returncode != 0]
+    if not failed:
+        return
+    for result in failed:
+        print(f"makr:   failed  {result.task}", file=file)
+    for task, upstream in skipped_tasks(graph, results).items():
+        why = f" (after {', '.join(upstream)})" if upstream else ''
+        print(f"makr:  skipped  {task}{why}", file=file)
+    for result in results:
+        if result.returncode == 0:
+            print(f"makr:       ok  {result.task}", file=file)
+
+
+def trace_lanes(results):
+    ''' give each result the lowest timeline lane free when it started '''
+    lanes = list()                          # end time of each lane's task
+    assigned = dict()
+    for result in sorted(results, key=lambda r: r.start):
+        for lane, end in enumerate(lanes):
+            if end <= result.start:
+                break
+        else:
+            lane = len(lanes)
+            lanes.append(0)
+        lanes[lane] = result.start + result.elapsed
+        assigned[result.task] = lane
+    return assigned
+
+
+def write_trace(results, fname):
+    ''' write results as Chrome trace-event JSON, for chrome://tracing
+        or https://ui.perfetto.dev '''
+    results = [r for r in results if r.start is not None]
+    t0 = min((r.start for r in results), default=0)
+    lanes = trace_lanes(results)
+    events = list()
+    for result in results:
+        args = {'task': result.task, 'returncode': result.returncode,
+                'note': result.note}
+        args.update(result.usage or dict())
+        events.append({'name': Path(result.task).name, 'cat': 'task',
+                       'ph': 'X', 'pid': 1, 'tid': lanes[result.task],
+                       'ts': round((result.start - t0) * 1e6),
+                       'dur': round(result.elapsed * 1e6), 'args': args})
+    with open(fname, 'wt') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f,
+                  indent=1)
+
+
+def print_summary(results, file=sys.stderr):
+    ''' a table of the tasks that ran, slowest first '''
+    if not results:
+        return
+    mb = 1024 * 1024
+    print(f"{'wall':>8} {'user':>8} {'sys':>8} {'max rss MB':>10} "
+          f"{'read MB':>8} {'write MB':>8}  task", file=file)
+    for result in sorted(results, key=lambda r: -r.elapsed):
+        use = result.usage
+        if use is None:
+            cols = f"{'-':>8} " * 2 + f"{'-':>10} " + f"{'-':>8} " * 2
+        else:
+            cols = (f"{use['utime']:8.1f} {use['stime']:8.1f} "
+                    f"{use['maxrss'] / mb:10.1f} "
+                    f"{use['read_bytes'] / mb:8.1f} "
+                    f"{use['write_bytes'] / mb:8.1f} ")
+        print(f"{result.elapsed:8.1f} {cols} {result.task}", file=file)
+
+
+def budget_use(results, needs, budget):
+    ''' how much of budget the tasks in results held while they ran:
+        {'cpus': fraction of cpu-seconds, 'mem': of byte-seconds,
+         'peak': Resources at the busiest moment, 'span': seconds,
+         'over': tasks with a process whose max rss was more than the
+         task asked for} '''
+    timed = [r for r in results if r.start is not None]
+    use = {'cpus': None, 'mem': None, 'peak': Resources(0, 0), 'span': 0.0,
+           'over': list()}
+    if not timed:
+        return use
+    begin = min(r.start for r in timed)
+    use['span'] = max(r.start + r.elapsed for r in timed) - begin
+    held = {r.task: fit(needs.get(r.task, Resources(1, 0)), budget)
+            for r in timed}
+    events = list()
+    for r in timed:
+        events.append((r.start, 1, held[r.task]))
+        events.append((r.start + r.elapsed, 0, held[r.task]))
+        maxrss = (r.usage or dict()).get('maxrss', 0)
+        if needs.get(r.task) and needs[r.task].mem and \
+                maxrss > needs[r.task].mem:
+            use['over'].append((r.task, maxrss))
+    now = peak = Resources(0, 0)
+    for _, starting, need in sorted(events, key=lambda e: e[:2]):
+        now = plus(now, need, 1 if starting else -1)
+        peak = Resources(max(peak.cpus, now.cpus), max(peak.mem, now.mem))
+    use['peak'] = peak
+    for k, limit in budget._asdict().items():
+        if limit and use['span'] > 0:
+            total = sum(getattr(held[r.task], k) * r.elapsed for r in timed)
+            use[k] = total / (limit * use['span'])
+    return use
+
+
+def print_budget(results, needs, budget, file=sys.stderr):
+    use = budget_use(results, needs, budget)
+    parts = list()
+    if use['cpus'] is not None:
+        parts.append(f"{use['cpus']:.0%} of {budget.cpus:g} cpus "
+                     f"(peak {use['peak'].cpus:g})")
+    if use['mem'] is not None:
+        parts.append(f"{use['mem']:.0%} of {budget.mem / 2**30:.1f} GB "
+                     f"(peak {use['peak'].mem / 2**30:.1f} GB)")
+    print(f"makr: budget use over {use['span']:.1f}s: "
+          f"{', '.join(parts) or 'no limits set'}", file=file)
+    for task, maxrss in use['over']:
+        print(f"makr: {task} had a process using {maxrss / 2**30:.1f} GB, "
+              f"more than its MAKR_MEM of {needs[task].mem / 2**30:.1f} GB",
+              file=file)
+
+
+def is_fresh(task):
+    ''' ask `make --question` whether task is up to date '''
+    prox = subprocess.run(make_command(['make', '--question'], task),
+                          cwd=task, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+    return prox.returncode == 0
+
+
+def plan_tasks(graph, jobs=1, fresh=is_fresh):
+    ''' a task is stale if make (or fresh) says it is out of date, or if any
+        task upstream of it is stale.  return {stale task: reason}
+    '''
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        fresh = dict(zip(graph.tasks, pool.map(fresh, graph.tasks)))
+    stale = dict()
+    for task in graph.order():
+        if not fresh[task]:
+            stale[task] = 'out of date'
+            continue
+        ups = [p for p in graph.upstream[task] if p in stale]
+        if ups:
+            stale[task] = f"upstream {ups[0]} is stale"
+    return stale
+
+
+def make_plan(base_task, verbose=False, cache=None, discover_jobs=1,
+              fast=True):
+    ''' find base_task's upstream graph and which tasks in it are stale
+        return (graph, {stale task: reason}) '''
     base_task = Path(base_task).resolve()
-    os.chdir(base_task)
-    pairs = follow_deps(str(base_task))
-    que = topological_sort(pairs)
-    for task in que:
-        os.chdir(task)
-        exec_make(['make'])
+    base_task = TaskResolver(cwd=base_task).task_path(base_task)
+    stats = dict()
+    pairs = discover_graph(base_task, stats=stats, cache=cache,
+                           jobs=discover_jobs, fast=fast)
+    if verbose:
+        print(f"discovery: {stats['queried']} make queries, "
+              f"{stats['read']} makefiles read directly, "
+              f"{stats['cached']} from cache, "
+              f"{stats['saved']} saved by visiting each task once",
+              file=sys.stderr)
+    graph = TaskGraph(pairs, tasks=[base_task])
+    return graph, plan_tasks(graph, jobs=discover_jobs)
+
+
+def print_plan(graph, stale, history=None, jobs=1, file=sys.stdout):
+    ''' what make_all would run, and why, in order.  with a
+        DurationHistory, also the estimated critical path and run time '''
+    for task in graph.order():
+        if task in stale:
+            print(f"run   {task}  ({stale[task]})", file=file)
+        else:
+            print(f"skip  {task}  (up to date)", file=file)
+    if history is None or not stale:
+        return
+    todo = graph.subgraph(stale)
+    priority, path = critical_path(todo, history.estimate)
+    print(f"critical path ({priority[path[0]]:.1f}s):", file=file)
+    for task in path:
+        print(f"  {history.estimate(task):8.1f}s  {task}", file=file)
+    total = sum(history.estimate(t) for t in todo.tasks)
+    makespan = simulate(todo, history.estimate, jobs=jobs, priority=priority)
+    print(f"estimated run time with -j {jobs}: {makespan:.1f}s "
+          f"({total:.1f}s of work)", file=file)
+
+
+def run_graph(graph, jobs=1, build=build_task, trace=None, history=None,
+              executor=run_tasks, budget=None, log=None, keep_going=False):
+    ''' run every task in graph, as make_all does with the stale ones:
+        longest estimated path first with a DurationHistory (which then
+        learns the new wall times), then write the trace if asked for and
+        print a summary.  executor runs the graph; it takes and returns
+        what run_tasks does.  with a budget, tasks are packed into it by
+        what task_needs says they need, and how full it was is printed.
+        with a history.BuildLog, the run is recorded in history.sqlite.
+        with keep_going, a failure only stops the tasks downstream of it;
+        either way, what failed, was skipped and succeeded is listed.
+        return the TaskResults '''
+    priority = None
+    if history is not None:
+        priority, _ = critical_path(graph, history.estimate)
+    needs = None
+    if budget is not None:
+        needs = {t: task_needs(t) for t in graph.tasks}
+    if log is not None:
+        build = log.recording(build)
+    results = executor(graph, jobs=jobs, report=print_result,
+                       build=build, priority=priority, needs=needs,
+                       budget=budget, keep_going=keep_going)
+    if history is not None:
+        for result in results:
+            if result.returncode == 0 and result.note is None:
+                history.add(result.task, result.elapsed)
+        history.save()
+    if trace:
+        write_trace(results, trace)
+    print_summary(results)
+    if budget is not None:
+        print_budget(results, needs, budget)
+    print_outcome(graph, results)
+    if log is not None:
+        log.record(results)
+    return results
+
+
+def make_all(base_task, verbose=False, cache=None, discover_jobs=1, jobs=1,
+             fast=True, hashes=None, trace=None, history=None, plan=None,
+             build=build_task, executor=run_tasks, budget=None, log=None,
+             keep_going=False, artifacts=None):
+    ''' make every stale task upstream of base_task, then base_task itself
+        if it is stale, running up to jobs tasks at once.
+        with a HashState, stale tasks whose inputs have the same contents
+        as at their last build are not run.
+        if trace is a filename, write a Chrome trace of the run to it.
+        with a DurationHistory, ready tasks on the longest estimated path
+        start first, and each task's wall time is added to the history.
+        plan is a (graph, stale) pair already worked out, e.g. by a daemon.
+        build(task) runs one task, as in run_tasks; executor(graph, ...)
+        runs them all, as run_tasks does, e.g. on other machines.
+        with a budget (Resources), tasks are packed into it, with a
+        history.BuildLog the run is recorded, and with keep_going only the
+        tasks downstream of a failure are skipped (see run_graph).
+        with an artifacts.ArtifactStore, a stale task whose inputs match a
+        stored build gets that output/ back instead of being made.
+        return the TaskResults '''
+    if plan is None:
+        plan = make_plan(base_task, verbose=verbose, cache=cache,
+                         discover_jobs=discover_jobs, fast=fast)
+    graph, stale = plan
+    if artifacts is not None:
+        build = artifacts.building(build)
+    if hashes is not None:
+        for task in graph.tasks:
+            if task not in stale and not hashes.has(task):
+                hashes.record(task)
+        build = functools.partial(build_task_hashed, hashes=hashes,
+                                  build=build)
+    try:
+        results = run_graph(graph.subgraph(stale), jobs=jobs, build=build,
+                            trace=trace, history=history, executor=executor,
+                            budget=budget, log=log, keep_going=keep_going)
+    finally:
+        if hashes is not None:
+            hashes.save()
+        if artifacts is not None:
+            artifacts.save()
+    failed = [r for r in results if r.returncode != 0]
+    unchanged = [r for r in results if r.note == 'unchanged']
+    restored = [r for r in results if r.note == 'restored']
+    print(f"makr: {len(results) - len(failed)} of {len(stale)} stale tasks "
+          f"ok ({len(unchanged)} unchanged, {len(restored)} restored), "
+          f"{len(failed)} failed, {len(stale) - len(results)} skipped, "
+          f"{len(graph) - len(stale)} up to date", file=sys.stderr)
+    return results
+
+
+def make_downstream(paths, jobs=1, cache=None, fast=True, trace=None,
+                    history=None, build=build_task, executor=run_tasks,
+                    budget=None, log=None, keep_going=False, artifacts=None):
+    ''' make the tasks holding paths, and every task anywhere in the
+        repository that depends on them, directly or not, in dependency
+        order.  nothing else is touched.  the other arguments are as for
+        make_all.  a changed task without a makefile is a source: its
+        dependents are made, it isn't.  return the TaskResults '''
+    resolver = TaskResolver(cwd=Path(paths[0]).resolve().parent)
+    changed = {resolver.task_path(p) for p in paths}
+    sources = {t for t in changed if makefile_for(t) is None}
+    errors = dict()
+    graph = index_repo(str(resolver.git_root), cache=cache, fast=fast,
+                       errors=errors)
+    for task, err in sorted(errors.items()):
+        print(f"makr: can't read {task}, its dependencies are "
+              f"ignored: {err}", file=sys.stderr)
+    for task in changed:
+        graph.add_task(task)
+    todo = graph.subgraph(graph.downstream_of(changed) - sources)
+    if artifacts is not None:
+        build = artifacts.building(build)
+    try:
+        results = run_graph(todo, jobs=jobs, build=build, trace=trace,
+                            history=history, executor=executor,
+                            budget=budget, log=log, keep_going=keep_going)
+    finally:
+        if artifacts is not None:
+            artifacts.save()
+    failed = [r for r in results if r.returncode != 0]
+    print(f"makr: {len(results) - len(failed)} of {len(todo)} tasks "
+          f"downstream of {len(changed)} changed ok, {len(failed)} failed, "
+          f"{len(todo) - len(results)} skipped, "
+          f"{len(graph) - len(todo)} untouched", file=sys.stderr)
+    return results
 
 
 # done.
@@ -0,0 +1,268 @@
+#! /usr/bin/env python3
+''' keep tasks' output/ by the contents of their inputs, and put it back '''
+# -*- mode: python; fill-column: 79; comment-column: 50 -*-
+#
+# Maintainer: PB
+# Created:    20261018
+# License:    (c) 2018 HRDAG, GPL-v2 or greater
+# ============================================
+#
+# a task's key is the sha1 of the names and contents of the files in its
+# src/, hand/ and input/ (through symlinks), its makefiles, and any other
+# prereq its makefile names outside its own output/.  after a task builds,
+# its output/ is copied into the store under that key; when the key comes
+# up again, on another branch or after a `make clean`, output/ is put back
+# instead of running make, by reflink where the filesystem can, by copy
+# where it can't, or by hardlink if asked.  stored files are read-only,
+# and any hardlinked output is copied before makr builds its task again,
+# with or without hardlinks this time, so a build can't rewrite the stored
+# copy through the link.  a plain `make` in a task restored by hardlink
+# gets no such copy: it fails on the read-only file, or as root writes
+# into the store.
+#
+# the store is a directory, git_root/.makr/artifacts unless given, with one
+# directory per key; several checkouts can share one.  when it grows past
+# its cap, the entries used longest ago are removed.  stats.json in the
+# store keeps hit and miss counts across runs.
+#
+# :on stderr: hits, misses and evictions, from print_stats()
+# ============================================
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+
+import makr as ut
+
+VERSION = 1
+CAP = '10G'
+KEYED_LEAVES = ("src", "hand", "input")
+FICLONE = 0x40049409                    # ioctl, from linux/fs.h
+COUNTS = ('hits', 'misses', 'stored', 'evicted', 'restored_bytes',
+          'stored_bytes')
+
+
+def walk_files(top):
+    ''' paths of the files under top, following symlinks '''
+    for dirpath, _, filenames in os.walk(top, followlinks=True):
+        for name in filenames:
+            yield os.path.join(dirpath, name)
+
+
+def reflink(src, dst):
+    ''' make dst share src's blocks (btrfs, xfs); raises OSError if the
+        filesystem can't '''
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class ArtifactStore:
+    ''' the store at root (default git_root/.makr/artifacts), holding up to
+        cap bytes.  restores hardlink if link, else reflink or copy '''
+    def __init__(self, root=None, git_root=None, cap=CAP, link=False,
+                 hashes=None):
+        git_root = git_root or ut.get_git_root()
+        self.root = Path(root or ut.state_path(git_root, 'artifacts'))
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.cap = ut.parse_size(cap) if isinstance(cap, str) else cap
+        self.link = link
+        self.hashes = hashes or ut.HashState(git_root)
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(COUNTS, 0)
+
+    def count(self, what, n=1):
+        with self.lock:
+            self.counts[what] += n
+
+    def key(self, task):
+        ''' the sha1 of task's inputs' names and contents '''
+        task = Path(task)
+        db, _ = ut.load_make_db(task)
+        names = {os.path.relpath(f, task)
+                 for leaf in KEYED_LEAVES for f in walk_files(task / leaf)}
+        names.update(db.makefiles)
+        names.add(ut.makefile_for(task))
+        output = (task / 'output').resolve()
+        for dep in db.deps():
+            path = (task / dep).resolve()
+            if output not in path.parents:
+                names.add(dep)
+        sha = hashlib.sha1(f'makr-artifacts-{VERSION}\n'.encode('utf-8'))
+        for name in sorted(n for n in names if n):
+            content = self.hashes.file_hash(task / name)
+            sha.update(f'{name}\0{content}\n'.encode('utf-8'))
+        return sha.hexdigest()
+
+    def entry(self, key):
+        return self.root / key[:2] / key
+
+    def _locked(self):
+        f = open(self.root / 'lock', 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def put(self, task, key):
+        ''' copy task's output/ into the store under key, then evict what
+            no longer fits '''
+        top = Path(task) / 'output'
+        files = sorted(os.path.relpath(f, top) for f in walk_files(top))
+        final = self.entry(key)
+        if not files or final.exists():
+            return
+        tmp = self.root / f'tmp-{os.getpid()}-{threading.get_ident()}-{key}'
+        size = 0
+        for name in files:
+            dst = tmp / 'files' / name
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            self._place(top / name, dst, link=False)
+            os.chmod(dst, 0o444)
+            size += dst.stat().st_size
+        with open(tmp / 'manifest.json', 'wt') as f:
+            json.dump({'task': Path(task).name, 'files': files,
+                       'bytes': size, 'stored': time.time()}, f)
+        final.parent.mkdir(exist_ok=True)
+        try:
+            os.rename(tmp, final)
+        except OSError:                 # another checkout stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.count('stored')
+        self.count('stored_bytes', size)
+        self.evict()
+
+    def _place(self, src, dst, link):
+        ''' dst as a hardlink (if link), reflink or copy of src.  return
+            True if it is a hardlink '''
+        if link:
+            try:
+                os.link(src, dst)
+                return True
+            except OSError:                     # e.g. another filesystem
+                pass
+        try:
+            reflink(src, dst)
+            shutil.copystat(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        return False
+
+    def restore(self, task, key):
+        ''' put the stored output/ for key back in task, newer than its
+            inputs.  return False if there is nothing stored for key '''
+        final = self.entry(key)
+        try:
+            with open(final / 'manifest.json', 'rt') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        os.utime(final / 'manifest.json')         # for the LRU
+        top = Path(task) / 'output'
+        now = time.time()
+        for name in manifest['files']:
+            dst = top / name
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            if dst.exists() or dst.is_symlink():
+                dst.unlink()
+            if not self._place(final / 'files' / name, dst, link=self.link):
+                os.chmod(dst, 0o644)
+            os.utime(dst, (now, now))
+        self.count('restored_bytes', manifest['bytes'])
+        return True
+
+    def unshare(self, task):
+        ''' give task private copies of outputs hardlinked from the store,
+            so a build can't write through them into it '''
+        top = Path(task) / 'output'
+        for fname in walk_files(top):
+            if os.lstat(fname).st_nlink < 2:
+                continue
+            tmp = f'{fname}.makr-{os.getpid()}'
+            shutil.copy2(fname, tmp)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, fname)
+
+    def entries(self):
+        ''' [(last used, bytes, path)] for every stored key '''
+        found = list()
+        for manifest in self.root.glob('??/*/manifest.json'):
+            try:
+                used = manifest.stat().st_mtime
+                with open(manifest, 'rt') as f:
+                    size = json.load(f)['bytes']
+            except (OSError, ValueError, KeyError):
+                continue
+            found.append((used, size, manifest.parent))
+        return sorted(found)
+
+    def evict(self):
+        ''' remove the least recently used entries until under the cap '''
+        with self._locked():
+            found = self.entries()
+            total = sum(size for _, size, _ in found)
+            for _, size, path in found:
+                if total <= self.cap:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                self.count('evicted')
+
+    def building(self, build):
+        ''' build, but restore the task's output/ instead if its key is in
+            the store and make then agrees it is up to date; store output/
+            after a build that succeeds '''
+        def cached(task):
+            start = time.time()
+            key = self.key(task)
+            if self.restore(task, key) and ut.is_fresh(task):
+                self.count('hits')
+                return ut.TaskResult(task, 0, time.time() - start,
+                                     'restored', start=start)
+            self.count('misses')
+            self.unshare(task)          # restored by this or an earlier run
+            result = build(task)
+            if result.returncode == 0:
+                self.put(task, key)
+            return result
+        return cached
+
+    def save(self):
+        ''' add this run's counts to the store's stats.json '''
+        self.hashes.save()
+        with self._locked():
+            totals = self.stats()
+            for what in COUNTS:
+                totals[what] = totals.get(what, 0) + self.counts[what]
+            tmp = self.root / f'stats.{os.getpid()}.tmp'
+            with open(tmp, 'wt') as f:
+                json.dump(totals, f)
+            os.replace(tmp, self.root / 'stats.json')
+
+    def stats(self):
+        ''' the counts in stats.json, for every run that used the store '''
+        try:
+            with open(self.root / 'stats.json', 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict.fromkeys(COUNTS, 0)
+
+    def print_stats(self, counts=None, file=sys.stderr):
+        ''' hits, misses and what moved, for this run or for counts '''
+        c = dict(dict.fromkeys(COUNTS, 0), **(counts or self.counts))
+        mb = 1024 * 1024
+        asked = c['hits'] + c['misses']
+        rate = c['hits'] / asked if asked else 0
+        used = sum(size for _, size, _ in self.entries())
+        print(f"makr: artifacts: {c['hits']} hits, {c['misses']} misses "
+              f"({rate:.0%} hit), {c['restored_bytes'] / mb:.1f} MB "
+              f"restored, {c['stored']} stored, {c['evicted']} evicted; "
+              f"{used / mb:.1f} of {self.cap / mb:.0f} MB in {self.root}",
+              file=file)
+
+
+# done.
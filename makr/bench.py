@@ -0,0 +1,171 @@
+#! /usr/bin/env python3
+''' synthetic PDP projects, and timings of makr's discovery, sorting and
+    rebuilds on them '''
+# -*- mode: python; fill-column: 79; comment-column: 50 -*-
+#
+# Maintainer: PB
+# Created:    20261018
+# License:    (c) 2018 HRDAG, GPL-v2 or greater
+# ============================================
+#
+# a generated project is a git repo of tasks task-0000 .. task-NNNN, where
+# each task's Makefile builds output/out.txt from src/run.sh, some hand/
+# files, and the outputs of up to fan_in earlier tasks, read either by
+# relative path or through a symlink in input/.  a final task, report,
+# depends on every task that nothing else uses.
+#
+# :on stdout: nothing; results are returned or written as json
+# ============================================
+
+import os
+import sys
+import json
+import time
+import random
+import contextlib
+import subprocess
+from pathlib import Path
+
+import makr as ut
+
+
+def make_project(root, ntasks=50, fan_in=3, fan_out=4, diamonds=0.3,
+                 symlinks=0.5, prereqs=3, seed=0):
+    ''' write a synthetic project under root, and `git init` it.
+        fan_in: most upstream tasks per task
+        fan_out: most downstream tasks per task
+        diamonds: chance of also depending on an upstream's upstream
+        symlinks: chance an upstream output is read through input/
+        prereqs: hand/ files per rule, besides src/ and upstream outputs
+        return the report task's path
+    '''
+    rng = random.Random(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    subprocess.run(['git', 'init', '-q', str(root)], check=True)
+    names = [f'task-{i:04d}' for i in range(ntasks)]
+    consumers = {name: 0 for name in names}
+    upstream = dict()
+    for i, name in enumerate(names):
+        pool = [n for n in names[:i] if consumers[n] < fan_out]
+        ups = rng.sample(pool, min(len(pool), rng.randint(0, fan_in)))
+        for up in list(ups):
+            grand = [g for g in upstream[up]
+                     if g not in ups and consumers[g] < fan_out]
+            if grand and rng.random() < diamonds:
+                ups.append(rng.choice(grand))
+        for up in ups:
+            consumers[up] += 1
+        upstream[name] = ups
+    sinks = [n for n in names if consumers[n] == 0]
+    upstream['report'] = sinks
+    for name in names + ['report']:
+        write_task(root / name, upstream[name], rng, symlinks, prereqs)
+    return str(root / 'report')
+
+
+def write_task(task, ups, rng, symlinks, prereqs):
+    for leaf in ('src', 'hand', 'input', 'output'):
+        (task / leaf).mkdir(parents=True, exist_ok=True)
+    (task / 'src' / 'run.sh').write_text('#!/bin/sh\necho ok\n')
+    deps = ['src/run.sh']
+    for k in range(prereqs):
+        (task / 'hand' / f'h{k}.txt').write_text(f'{task.name} {k}\n')
+        deps.append(f'hand/h{k}.txt')
+    for up in ups:
+        if rng.random() < symlinks:
+            link = task / 'input' / f'{up}.txt'
+            link.symlink_to(f'../../{up}/output/out.txt')
+            deps.append(f'input/{up}.txt')
+        else:
+            deps.append(f'../{up}/output/out.txt')
+    continued = ' \\\n\t\t'.join(deps)
+    (task / 'Makefile').write_text(
+        '.PHONY: all clean\n'
+        'all: output/out.txt\n'
+        'clean:\n\trm output/*\n\n'
+        f'output/out.txt: \\\n\t\t{continued}\n'
+        '\tsh src/run.sh > $@\n')
+
+
+@contextlib.contextmanager
+def quiet():
+    ''' send this process's and its children's stdout and stderr to
+        /dev/null '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(os.devnull, 'wb') as null:
+        os.dup2(null.fileno(), 1)
+        os.dup2(null.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+
+
+def timed(timings, name, fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    timings[name] = round(time.perf_counter() - start, 4)
+    return value
+
+
+def run_benchmark(root, jobs=1, **params):
+    ''' generate a project under root with params (see make_project) and
+        time makr on it.  return a dict of the params and timings '''
+    report = make_project(root, **params)
+    timings = dict()
+    git_root = ut.get_git_root(cwd=report)
+    with quiet():
+        pairs = timed(timings, 'discover_make', ut.discover_graph, report,
+                      fast=False)
+        timed(timings, 'discover_fast', ut.discover_graph, report)
+        timed(timings, 'discover_jobs', ut.discover_graph, report,
+              jobs=max(jobs, 4), fast=False)
+        cache = ut.DepCache(git_root)
+        ut.discover_graph(report, cache=cache)
+        timed(timings, 'discover_cached', ut.discover_graph, report,
+              cache=ut.DepCache(git_root))
+        timed(timings, 'sort', ut.topological_sort, pairs)
+        timed(timings, 'build', ut.make_all, report, jobs=jobs)
+        timed(timings, 'noop', ut.make_all, report, jobs=jobs)
+        leaf = Path(root) / 'task-0000' / 'hand' / 'h0.txt'
+        if not leaf.exists():
+            leaf = Path(root) / 'task-0000' / 'src' / 'run.sh'
+        os.utime(leaf)
+        timed(timings, 'leaf_change', ut.make_all, report, jobs=jobs)
+    params = dict(params, jobs=jobs, edges=len(pairs))
+    return {'params': params, 'timings': timings}
+
+
+def compare(old, new, threshold=0.25, floor=0.05):
+    ''' timings in new that are more than threshold (a fraction) slower
+        than in old, ignoring differences under floor seconds.
+        return [(name, old seconds, new seconds)] '''
+    slower = list()
+    for name, then in sorted(old['timings'].items()):
+        now = new['timings'].get(name)
+        if now is None:
+            continue
+        if now > then * (1 + threshold) and now - then > floor:
+            slower.append((name, then, now))
+    return slower
+
+
+def save(result, fname):
+    with open(fname, 'wt') as f:
+        json.dump(result, f, indent=2)
+
+
+def load(fname):
+    with open(fname, 'rt') as f:
+        return json.load(f)
+
+
+# done.
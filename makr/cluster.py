@@ -0,0 +1,330 @@
+#! /usr/bin/env python3
+''' run a task graph on workers that may be on other machines '''
+# -*- mode: python; fill-column: 79; comment-column: 50 -*-
+#
+# Maintainer: PB
+# Created:    20261018
+# License:    (c) 2018 HRDAG, GPL-v2 or greater
+# ============================================
+#
+# a Coordinator listens on a unix socket, or on host:port for workers on
+# other nodes that see the same filesystem.  each worker connects, and
+# then asks for a task, runs make in it, and sends back the TaskResult,
+# over and over.  a worker started from the command line runs its makes
+# on an engine.Engine, so --timeout, prefixed output and logs work there
+# too.  the coordinator hands out ready tasks from the front of
+# the graph exactly as run_tasks does (highest priority first, nothing new
+# after a failure, or with keep_going nothing downstream of it), and puts a
+# task back on the queue if its worker goes away mid-build.
+# Coordinator.run_tasks has run_tasks' signature, so it can be passed to
+# make_all as the executor.  workers stay connected between runs and exit
+# when the coordinator closes.
+#
+# messages are json, one per line.
+# :on stderr: per-worker throughput and queue waits, from print_report()
+# ============================================
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+import makr as ut
+import makr.daemon
+import makr.engine
+
+PATIENCE = 60.0                         # seconds to wait for any worker
+
+
+def parse_address(address):
+    ''' (socket family, address) for 'host:port' or a unix socket path '''
+    address = str(address)
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def send(f, msg):
+    f.write(json.dumps(msg).encode('utf-8') + b'\n')
+    f.flush()
+
+
+def recv(f):
+    ''' the next message from f, or None if the other end went away '''
+    try:
+        line = f.readline()
+    except OSError:
+        return None
+    return json.loads(line) if line else None
+
+
+class Coordinator:
+    ''' hands ready tasks to the workers connected at address '''
+    def __init__(self, address, patience=PATIENCE):
+        self.address = str(address)
+        self.patience = patience
+        self.cond = threading.Condition()
+        self.closed = False
+        self.procs = list()
+        self.workers = dict()               # name -> metrics
+        self.connected = 0
+        self._reset(ut.TaskGraph())
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(64)
+        self.acceptor = threading.Thread(target=self._accept, daemon=True)
+        self.acceptor.start()
+
+    def _reset(self, graph, report=None, priority=None, keep_going=False,
+               needs=None, budget=None):
+        self.graph = graph
+        self.keep_going = keep_going
+        self.budget = budget or ut.Resources(None, None)
+        self.needs = {t: ut.fit((needs or dict()).get(t, ut.Resources(1, 0)),
+                                self.budget)
+                      for t in graph.tasks}
+        self.used = ut.Resources(0, 0)
+        self.waiting = {t: len(ups) for t, ups in graph.upstream.items()}
+        self.ready = ut.ReadyQueue(priority)
+        self.readied = dict()               # task -> when it became ready
+        self.running = dict()               # task -> worker name
+        self.results = list()
+        self.failed = False
+        self.report = report
+
+    def _push(self, task):
+        self.ready.push(task)
+        self.readied[task] = time.time()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def _serve(self, conn):
+        ''' one worker's connection: hand it tasks until we close '''
+        with conn, conn.makefile('rwb') as f:
+            hello = recv(f)
+            if not hello:
+                return
+            name = hello.get('worker') or f'worker-{len(self.workers)}'
+            stats = self.workers.setdefault(name, {
+                'tasks': 0, 'failed': 0, 'busy': 0.0, 'idle': 0.0,
+                'waits': list(), 'joined': time.time()})
+            with self.cond:
+                self.connected += 1
+            try:
+                while True:
+                    asked = time.time()
+                    task, waited = self._next_task(name)
+                    stats['idle'] += time.time() - asked
+                    try:
+                        send(f, {'task': task})
+                    except OSError:
+                        if task is not None:
+                            self._requeue(task)
+                        return
+                    if task is None:
+                        return
+                    stats['waits'].append(waited)
+                    reply = recv(f)
+                    if reply is None:
+                        self._requeue(task)
+                        return
+                    result = ut.TaskResult(**reply['result'])
+                    stats['tasks'] += 1
+                    stats['failed'] += result.returncode != 0
+                    stats['busy'] += result.elapsed
+                    self._finish(task, result)
+            finally:
+                with self.cond:
+                    self.connected -= 1
+                    self.cond.notify_all()
+
+    def _fits(self, task):
+        return ut.within(ut.plus(self.used, self.needs[task]), self.budget)
+
+    def _next_task(self, name):
+        ''' the next ready task that fits in the budget, for worker name,
+            and how long it waited to be picked up; (None, None) once we
+            close '''
+        with self.cond:
+            while True:
+                if self.closed:
+                    return None, None
+                if self.ready and not self.failed:
+                    task = self.ready.pop(self._fits)
+                    if task is not None:
+                        break
+                self.cond.wait()
+            self.used = ut.plus(self.used, self.needs[task])
+            self.running[task] = name
+            return task, time.time() - self.readied[task]
+
+    def _release(self, task):
+        ''' take task off the running list; False if it wasn't on it '''
+        if self.running.pop(task, None) is None:
+            return False
+        self.used = ut.plus(self.used, self.needs[task], -1)
+        return True
+
+    def _requeue(self, task):
+        with self.cond:
+            if self._release(task):
+                self._push(task)
+            self.cond.notify_all()
+
+    def _finish(self, task, result):
+        with self.cond:
+            self._release(task)
+            self.results.append(result)
+            if self.report:
+                self.report(result)
+            if result.returncode != 0:
+                self.failed = not self.keep_going
+            else:
+                for nxt in self.graph.downstream[task]:
+                    self.waiting[nxt] -= 1
+                    if self.waiting[nxt] == 0:
+                        self._push(nxt)
+            self.cond.notify_all()
+
+    def run_tasks(self, graph, jobs=1, report=None, build=None,
+                  priority=None, needs=None, budget=None, keep_going=False):
+        ''' run_tasks, on the workers: jobs and build are ignored, since
+            each worker runs one task at a time with its own build.  as in
+            run_tasks, a task is only handed out if its needs fit in what
+            the running tasks leave of the budget.
+            return TaskResults in the order the tasks finished '''
+        with self.cond:
+            self._reset(graph, report, priority, keep_going, needs, budget)
+            for task in graph.levels()[0] if len(graph) else []:
+                self._push(task)
+            self.cond.notify_all()
+            alone = None
+            while self.running or (self.ready and not self.failed):
+                self.cond.wait(1.0)
+                if self.connected:
+                    alone = None
+                    continue
+                alone = alone or time.time()
+                if time.time() - alone > self.patience:
+                    errmsg = (f"no workers connected to {self.address} "
+                              f"for {self.patience}s")
+                    raise RuntimeError(errmsg)
+            results = self.results
+            self._reset(ut.TaskGraph())
+        return results
+
+    def start_workers(self, n, timeout=None):
+        ''' start n workers on this machine, as child processes, killing
+            any make that runs longer than timeout seconds '''
+        extra = ['--timeout', str(timeout)] if timeout else list()
+        for i in range(n):
+            self.procs.append(subprocess.Popen(
+                [sys.executable, '-m', 'makr.cluster', self.address,
+                 '--name', f'local-{len(self.procs)}'] + extra,
+                stdin=subprocess.DEVNULL, env=makr.daemon.module_env()))
+
+    def close(self):
+        ''' send the workers home, and wait for any we started '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for proc in self.procs:
+            proc.wait()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+        except OSError:
+            pass
+        self.acceptor.join()
+        self.sock.close()
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def metrics(self):
+        ''' {worker: tasks, failed, busy and idle seconds, throughput in
+            tasks per minute connected, and mean and most seconds its tasks
+            sat ready before it took them} '''
+        now = time.time()
+        out = dict()
+        for name, stats in sorted(self.workers.items()):
+            waits = stats['waits'] or [0.0]
+            minutes = max(now - stats['joined'], 1e-6) / 60
+            out[name] = {'tasks': stats['tasks'], 'failed': stats['failed'],
+                         'busy': stats['busy'], 'idle': stats['idle'],
+                         'per_minute': stats['tasks'] / minutes,
+                         'wait_mean': sum(waits) / len(waits),
+                         'wait_max': max(waits)}
+        return out
+
+    def print_report(self, file=sys.stderr):
+        print(f"{'tasks':>6} {'failed':>6} {'busy s':>8} {'idle s':>8} "
+              f"{'per min':>8} {'wait s':>7} {'max s':>7}  worker",
+              file=file)
+        for name, m in self.metrics().items():
+            print(f"{m['tasks']:6d} {m['failed']:6d} {m['busy']:8.1f} "
+                  f"{m['idle']:8.1f} {m['per_minute']:8.1f} "
+                  f"{m['wait_mean']:7.2f} {m['wait_max']:7.2f}  {name}",
+                  file=file)
+
+
+def work(address, name=None, build=ut.build_task):
+    ''' be a worker for the coordinator at address until it closes.
+        return the number of tasks run '''
+    family, addr = parse_address(address)
+    name = name or f'{socket.gethostname()}:{os.getpid()}'
+    count = 0
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(addr)
+        with sock.makefile('rwb') as f:
+            send(f, {'worker': name})
+            while True:
+                msg = recv(f)
+                if not msg or msg.get('task') is None:
+                    return count
+                result = build(msg['task'])
+                send(f, {'result': result._asdict()})
+                count += 1
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="run tasks handed out by a makr coordinator")
+    parser.add_argument('address', action="store", type=str,
+                        help="host:port, or the path of a unix socket")
+    parser.add_argument('--name', action="store", type=str, default=None,
+                        help="what the coordinator calls this worker")
+    parser.add_argument('--timeout', action="store", type=float,
+                        default=None, metavar='SECONDS',
+                        help="kill a task's make after this long")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    with makr.engine.Engine(timeout=args.timeout) as engine:
+        work(args.address, name=args.name, build=engine.build)
+
+# done.
@@ -0,0 +1,325 @@
+#! /usr/bin/env python3
+''' a resident makr per git root, keeping the task graph warm between runs '''
+# -*- mode: python; fill-column: 79; comment-column: 50 -*-
+#
+# Maintainer: PB
+# Created:    20261018
+# License:    (c) 2018 HRDAG, GPL-v2 or greater
+# ============================================
+#
+# the daemon listens on a unix socket, git_root/.makr/daemon.sock, and
+# answers one json request per connection with one json reply, each a
+# single line.  it keeps every task's parsed makefile, the upstream tasks
+# its prereqs resolve to, and the last `make --question` answer for it.
+# a task's entry lives in a DepCache, so it is thrown out as soon as a
+# makefile it read (or a symlinked prereq) changes; a freshness answer is
+# reused only while none of the task's targets and prereqs has moved.
+# clients find the git root without running git, and when nothing is
+# listening they get None back and do the work themselves.  the daemon
+# exits after idle seconds without a request.
+#
+# :on stdout: nothing; errors go to git_root/.makr/daemon.log
+# ============================================
+
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import makr as ut
+
+IDLE = 1800
+SOCKET = 'daemon.sock'
+
+
+def find_git_root(path):
+    ''' the nearest directory at or above path with a .git in it, found
+        without running git, or None '''
+    path = Path(path).resolve()
+    for parent in [path] + list(path.parents):
+        if (parent / '.git').exists():
+            return str(parent)
+    return None
+
+
+def socket_path(git_root, name=SOCKET):
+    ''' git_root/.makr/name, or a name in the temp dir if that is too long
+        for a unix socket address '''
+    path = ut.state_path(git_root, name)
+    if len(os.fsencode(str(path))) < 100:
+        return path
+    digest = hashlib.sha1(os.fsencode(str(path))).hexdigest()[:16]
+    return Path(tempfile.gettempdir()) / f'makr-{os.getuid()}-{digest}.sock'
+
+
+def module_env():
+    ''' os.environ, with this copy of makr first on PYTHONPATH, for running
+        `python -m makr.something` in a child '''
+    env = dict(os.environ)
+    here = str(Path(ut.__file__).resolve().parent.parent)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (here, env.get('PYTHONPATH')) if p)
+    return env
+
+
+class Daemon:
+    ''' the state kept for one git root, and the loop that serves it '''
+    def __init__(self, git_root, idle=IDLE):
+        self.git_root = str(Path(git_root).resolve())
+        self.idle = idle
+        self.cache = ut.DepCache(self.git_root)
+        self.resolver = ut.TaskResolver(git_root=self.git_root)
+        self.dbs = dict()                   # task -> MakeDatabase
+        self.fresh = dict()                 # task -> (signature, fresh)
+        self.started = time.time()
+        self.requests = 0
+        self.running = False
+        self.ops = {'ping': self.ping, 'graph': self.graph,
+                    'plan': self.plan, 'deps': self.deps,
+                    'targets': self.targets, 'stop': self.stop}
+
+    def query(self, task):
+        ''' task's upstream tasks, re-reading its makefile only if it (or
+            anything it includes) changed since we last did '''
+        hit = self.cache.lookup(task)
+        if hit is not None and task in self.dbs:
+            return hit[1]
+        if hit is None:
+            self.resolver.tasks.clear()     # the tree may have moved too
+            self.fresh.pop(task, None)
+        db, _ = ut.load_make_db(task)
+        deps = db.deps()
+        tasks = ut.get_tasks_from_deps(task, deps, resolver=self.resolver)
+        self.cache.store(task, deps, tasks, db.makefiles)
+        self.dbs[task] = db
+        return tasks
+
+    def task(self, path):
+        return self.resolver.task_path(Path(path).resolve())
+
+    def pairs(self, base_task):
+        pairs = set()
+        seen = {base_task}
+        todo = [base_task]
+        while todo:
+            task = todo.pop()
+            for prereq in self.query(task):
+                pairs.add((prereq, task))
+                if prereq not in seen:
+                    seen.add(prereq)
+                    todo.append(prereq)
+        self.cache.save()
+        return sorted(pairs)
+
+    def signature(self, task):
+        ''' mtimes of everything make --question would look at for task '''
+        db = self.dbs[task]
+        names = set(db.deps()) | {r.target for r in db.file_rules()}
+        names.update(db.makefiles)
+        sig = list()
+        for name in sorted(names):
+            try:
+                sig.append((name, os.stat(Path(task) / name).st_mtime_ns))
+            except OSError:
+                sig.append((name, None))
+        return sig
+
+    def is_fresh(self, task):
+        sig = self.signature(task)
+        memo = self.fresh.get(task)
+        if memo is not None and memo[0] == sig:
+            return memo[1]
+        fresh = ut.is_fresh(task)
+        self.fresh[task] = (sig, fresh)
+        return fresh
+
+    def ping(self, request):
+        return {'pid': os.getpid(), 'git_root': self.git_root,
+                'tasks': len(self.dbs), 'requests': self.requests,
+                'uptime': round(time.time() - self.started, 1)}
+
+    def graph(self, request):
+        base_task = self.task(request['task'])
+        return {'task': base_task, 'pairs': self.pairs(base_task)}
+
+    def plan(self, request):
+        base_task = self.task(request['task'])
+        graph = ut.TaskGraph(self.pairs(base_task), tasks=[base_task])
+        stale = ut.plan_tasks(graph, fresh=self.is_fresh)
+        return {'task': base_task, 'pairs': graph.pairs(),
+                'stale': stale}
+
+    def deps(self, request):
+        task = self.task(request['task'])
+        self.query(task)
+        return {'task': task,
+                'deps': self.dbs[task].deps(request.get('target'))}
+
+    def targets(self, request):
+        task = self.task(request['task'])
+        self.query(task)
+        return {'task': task,
+                'targets': ut.target_deps(self.dbs[task], task,
+                                          request.get('targets'),
+                                          resolver=self.resolver)}
+
+    def stop(self, request):
+        self.running = False
+        return dict()
+
+    def handle(self, conn):
+        ''' read one request from conn and write its reply '''
+        self.requests += 1
+        with conn.makefile('rb') as f:
+            line = f.readline()
+        try:
+            request = json.loads(line)
+            reply = self.ops[request['op']](request)
+            reply['ok'] = True
+        except Exception as exc:
+            reply = {'ok': False, 'error': f"{type(exc).__name__}: {exc}"}
+        conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+
+    def serve(self):
+        ''' answer requests until stopped or idle.  only one daemon serves
+            a git root at a time; return False if another one is '''
+        lock = open(ut.state_path(self.git_root, 'daemon.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        path = socket_path(self.git_root)
+        if path.exists():
+            path.unlink()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(str(path))
+        sock.listen(16)
+        sock.settimeout(min(self.idle, 5))
+        last = time.time()
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    if time.time() - last > self.idle:
+                        break
+                    continue
+                with conn:
+                    conn.settimeout(None)
+                    self.handle(conn)
+                last = time.time()
+        finally:
+            sock.close()
+            if path.exists():
+                path.unlink()
+            self.cache.save()
+            lock.close()
+        return True
+
+
+def request(git_root, op, **args):
+    ''' send one request to git_root's daemon and return its reply, or None
+        if no daemon is listening '''
+    path = socket_path(git_root)
+    if not path.exists():
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(path))
+            sock.sendall(json.dumps(dict(args, op=op)).encode('utf-8') +
+                         b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except OSError:
+        return None
+    if not line:
+        return None
+    reply = json.loads(line)
+    if not reply.pop('ok'):
+        errmsg = f"makr daemon: {reply['error']}"
+        raise RuntimeError(errmsg)
+    return reply
+
+
+def plan(task, git_root=None):
+    ''' (graph, stale) for task like make_plan, from the daemon, or None '''
+    git_root = git_root or find_git_root(task)
+    reply = git_root and request(git_root, 'plan', task=str(task))
+    if not reply:
+        return None
+    graph = ut.TaskGraph([tuple(p) for p in reply['pairs']],
+                         tasks=[reply['task']])
+    return graph, reply['stale']
+
+
+def deps(task, target=None, git_root=None):
+    ''' task's prereqs like get_deps_from_make, from the daemon, or None '''
+    git_root = git_root or find_git_root(task)
+    reply = git_root and request(git_root, 'deps', task=str(task),
+                                 target=target)
+    if not reply:
+        return None
+    return reply['deps']
+
+
+def targets(task, targets=None, git_root=None):
+    ''' ut.target_deps for task, from the daemon, or None '''
+    git_root = git_root or find_git_root(task)
+    reply = git_root and request(git_root, 'targets', task=str(task),
+                                 targets=targets)
+    if not reply:
+        return None
+    return reply['targets']
+
+
+def start(git_root, idle=IDLE, wait=10.0):
+    ''' start a daemon for git_root in the background, unless one is
+        already running.  return its ping reply '''
+    reply = request(git_root, 'ping')
+    if reply:
+        return reply
+    with open(ut.state_path(git_root, 'daemon.log'), 'ab') as log:
+        subprocess.Popen([sys.executable, '-m', 'makr.daemon',
+                          str(git_root), '--idle', str(idle)],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=log, env=module_env(),
+                         start_new_session=True)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        reply = request(git_root, 'ping')
+        if reply:
+            return reply
+        time.sleep(0.05)
+    errmsg = f"makr daemon for {git_root} didn't start, see .makr/daemon.log"
+    raise RuntimeError(errmsg)
+
+
+def stop(git_root):
+    ''' stop git_root's daemon.  return False if none was running '''
+    return request(git_root, 'stop') is not None
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="serve makr queries for one git root")
+    parser.add_argument('git_root', action="store", type=str)
+    parser.add_argument('--idle', action="store", type=float, default=IDLE,
+                        metavar='SECONDS',
+                        help="exit after this long without a request")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    Daemon(args.git_root, idle=args.idle).serve()
+
+# done.
@@ -0,0 +1,257 @@
+#! /usr/bin/env python3
+''' run makes on an asyncio event loop, with prefixed output and logs '''
+# -*- mode: python; fill-column: 79; comment-column: 50 -*-
+#
+# Maintainer: PB
+# Created:    20261018
+# License:    (c) 2018 HRDAG, GPL-v2 or greater
+# ============================================
+#
+# an Engine owns one event loop, on its own thread, which starts every
+# make, reads its stdout and stderr as lines arrive, and reaps it.  each
+# line is copied to our stdout or stderr behind the task's name, so the
+# output of tasks running at once stays readable, and to the task's log in
+# git_root/.makr/logs/.  make runs in a session of its own, so a timeout
+# or a Ctrl-C can kill it and everything it started as one process group.
+# Engine.build and Engine.read_make_db are plain functions that block
+# until their make is done, so they can stand in for build_task and
+# read_make_db anywhere, including from run_tasks' threads.
+#
+# :on stdout, stderr: the tasks' output, line by line, prefixed
+# ============================================
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import threading
+import subprocess
+from pathlib import Path
+
+import makr as ut
+
+GRACE = 5.0                                       # seconds from TERM to KILL
+
+
+class LineSplitter:
+    ''' turns chunks of bytes into whole lines, keeping the partial tail '''
+    def __init__(self):
+        self.tail = b''
+
+    def feed(self, chunk):
+        lines = (self.tail + chunk).split(b'\n')
+        self.tail = lines.pop()
+        return lines
+
+    def close(self):
+        tail, self.tail = self.tail, b''
+        return [tail] if tail else list()
+
+
+class Engine:
+    ''' an event loop on a thread of its own, running makes for callers on
+        any thread.  use it as a context manager, or call close() '''
+    def __init__(self, git_root=None, timeout=None, logs=True, prefix=True,
+                 out=None, err=None, grace=GRACE):
+        self.git_root = Path(git_root or ut.get_git_root())
+        self.timeout = timeout
+        self.logs = logs
+        self.prefix = prefix
+        self.out = out or sys.stdout
+        self.err = err or sys.stderr
+        self.grace = grace
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.jobs = set()                   # asyncio tasks from submit()
+        self.sigint = None
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread():
+            self.sigint = signal.signal(signal.SIGINT, self._interrupt)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _interrupt(self, signum, frame):
+        self.cancel()
+        raise KeyboardInterrupt
+
+    def name(self, task):
+        return os.path.relpath(task, self.git_root)
+
+    def log_path(self, task):
+        return ut.state_path(self.git_root, 'logs') / f'{self.name(task)}.log'
+
+    def submit(self, coro):
+        ''' run coro on the loop; return a concurrent.futures.Future '''
+        return asyncio.run_coroutine_threadsafe(self._job(coro), self.loop)
+
+    async def _job(self, coro):
+        job = asyncio.current_task()
+        self.jobs.add(job)
+        try:
+            return await coro
+        finally:
+            self.jobs.discard(job)
+
+    def cancel(self):
+        ''' stop every running make, killing its process group, and any
+            waiting for a jobserver slot '''
+        if ut.Jobserver.active is not None:
+            ut.Jobserver.active.cancel()
+
+        def cancel_all():
+            for job in list(self.jobs):
+                job.cancel()
+        self.loop.call_soon_threadsafe(cancel_all)
+
+    def close(self):
+        ''' wait for (or kill, if interrupted) what is running, then stop
+            the loop and put Ctrl-C back as it was '''
+        if self.sigint is not None:
+            signal.signal(signal.SIGINT, self.sigint)
+            self.sigint = None
+        if not self.loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _drain(self):
+        others = [t for t in asyncio.all_tasks()
+                  if t is not asyncio.current_task()]
+        await asyncio.gather(*others, return_exceptions=True)
+
+    async def _reap(self, pid):
+        ''' wait4 pid without blocking the loop: wait for its pidfd to be
+            readable where there is one, else wait on an executor thread '''
+        loop = asyncio.get_running_loop()
+        try:
+            fd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            return await loop.run_in_executor(None, os.wait4, pid, 0)
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+        return os.wait4(pid, 0)
+
+    async def _kill(self, proc, reaping):
+        ''' TERM proc's process group, then KILL it if it lingers '''
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+            done, _ = await asyncio.wait([reaping], timeout=self.grace)
+            if done:
+                return reaping.result()
+        return await reaping
+
+    async def _pump(self, pipe, handle):
+        ''' call handle(line) for each line of pipe, as bytes '''
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=1 << 20)
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        lines = LineSplitter()
+        try:
+            while True:
+                chunk = await reader.read(1 << 16)
+                for line in lines.feed(chunk) if chunk else lines.close():
+                    handle(line)
+                if not chunk:
+                    break
+        finally:
+            transport.close()
+
+    def _echo(self, stream, prefix, log):
+        ''' a handler copying lines to stream behind prefix, and to log '''
+        def handle(line):
+            if log is not None:
+                log.write(line + b'\n')
+            text = line.decode('utf-8', errors='replace')
+            stream.write(f'{prefix}{text}\n')
+            stream.flush()
+        return handle
+
+    async def run(self, args, cwd, name, log=None, stdout=True):
+        ''' run args in cwd as the leader of a new process group, passing
+            its output through (or, if stdout is a callable, handing it
+            each line of stdout, as bytes, instead).  return (returncode,
+            rusage, note), where note is 'timeout' if it ran too long '''
+        prefix = f'{name}| ' if self.prefix else ''
+        proc = subprocess.Popen(args, cwd=cwd, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                start_new_session=True, **ut.make_kwargs(cwd))
+        if callable(stdout):
+            handle = stdout
+        else:
+            handle = self._echo(self.out, prefix, log)
+        pumps = [asyncio.ensure_future(self._pump(proc.stdout, handle)),
+                 asyncio.ensure_future(self._pump(
+                     proc.stderr, self._echo(self.err, prefix, log)))]
+        reaping = asyncio.ensure_future(self._reap(proc.pid))
+        note = None
+        try:
+            done, _ = await asyncio.wait([reaping], timeout=self.timeout)
+            if not done:
+                note = 'timeout'
+                await self._kill(proc, reaping)
+        except asyncio.CancelledError:
+            await self._kill(proc, reaping)
+            raise
+        finally:
+            done, late = await asyncio.wait(pumps, timeout=self.grace)
+            for pump in late:                   # a grandchild kept a pipe
+                pump.cancel()
+        _, status, rusage = reaping.result()
+        proc.returncode = ut.exit_code(status)
+        return proc.returncode, rusage, note
+
+    async def build_async(self, task):
+        start = time.time()
+        log = None
+        if self.logs:
+            fname = self.log_path(task)
+            fname.parent.mkdir(parents=True, exist_ok=True)
+            log = open(fname, 'wb')
+        try:
+            rc, rusage, note = await self.run(
+                ut.make_command(['make'], task), task, self.name(task), log)
+        finally:
+            if log is not None:
+                log.close()
+        return ut.TaskResult(task, rc, time.time() - start, note,
+                             start=start, usage=ut.rusage_dict(rusage))
+
+    async def read_make_db_async(self, task):
+        task = Path(task).resolve()
+        db = ut.MakeDatabase()
+        make_args = ut.make_command(
+            ['make', '--dry-run', '--print-data-base'], task)
+
+        def feed(line):
+            db.feed(line.decode('utf-8', errors='replace') + '\n')
+        await self.run(make_args, task, self.name(task), stdout=feed)
+        return db
+
+    def build(self, task):
+        ''' as build_task, with the output prefixed and logged '''
+        return self.submit(self.build_async(task)).result()
+
+    def read_make_db(self, task):
+        ''' as read_make_db; make's stderr is passed through prefixed '''
+        return self.submit(self.read_make_db_async(task)).result()
+
+
+# done.
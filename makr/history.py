@@ -0,0 +1,203 @@
+#! /usr/bin/env python3
+''' every run of makr, and each task in it, kept in sqlite '''
+# -*- mode: python; fill-column: 79; comment-column: 50 -*-
+#
+# Maintainer: PB
+# Created:    20261018
+# License:    (c) 2018 HRDAG, GPL-v2 or greater
+# ============================================
+#
+# git_root/.makr/history.sqlite has a row in runs for each makr run that
+# built something, and a row in tasks for each task it ran: when it started
+# and ended, make's exit code, which files in output/ make rewrote, and how
+# many files and bytes output/ held afterwards.  a BuildLog wraps the build
+# function to look at output/ before and after each task, keeps the rows in
+# memory, and writes them all in one transaction when the run is done.
+# for a task built where the wrapper can't see it (on a cluster worker),
+# the files in output/ modified since the task started count as rewritten.
+#
+# :on stdout: the --history reports
+# ============================================
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+import makr as ut
+
+VERSION = 1
+SLACK = 1.0                             # seconds: coarse or remote fs clocks
+SCHEMA = '''
+create table if not exists runs (
+    id integer primary key,
+    started real, ended real,
+    command text, tasks integer, failed integer);
+create table if not exists tasks (
+    run integer references runs(id),
+    task text, started real, ended real,
+    returncode integer, note text,
+    rebuilt text, output_files integer, output_bytes integer,
+    utime real, stime real, maxrss integer);
+create index if not exists tasks_task on tasks(task, started);
+'''
+
+
+def connect(git_root):
+    db = sqlite3.connect(str(ut.state_path(git_root, 'history.sqlite')),
+                         timeout=30)
+    if db.execute('pragma user_version').fetchone()[0] != VERSION:
+        db.executescript(SCHEMA)
+        db.execute(f'pragma user_version = {VERSION}')
+    return db
+
+
+def scan_output(task):
+    ''' {path under output/: (mtime_ns, size)} '''
+    files = dict()
+    top = Path(task) / 'output'
+    for dirpath, _, filenames in os.walk(top):
+        for name in filenames:
+            fname = os.path.join(dirpath, name)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            files[os.path.relpath(fname, top)] = (st.st_mtime_ns, st.st_size)
+    return files
+
+
+class BuildLog:
+    ''' what one run of makr built, on its way to history.sqlite '''
+    def __init__(self, git_root=None, command=None):
+        self.git_root = Path(git_root or ut.get_git_root())
+        self.command = command or ' '.join(sys.argv)
+        self.started = time.time()
+        self.outputs = dict()           # task -> (rebuilt, files, bytes)
+        self.lock = threading.Lock()
+
+    def recording(self, build):
+        ''' build, noting what each task rewrote in output/ '''
+        def recorded(task):
+            before = scan_output(task)
+            result = build(task)
+            after = scan_output(task)
+            rebuilt = sorted(f for f, (mtime, _) in after.items()
+                             if before.get(f, (None,))[0] != mtime)
+            with self.lock:
+                self.outputs[task] = (rebuilt, len(after),
+                                      sum(size for _, size in after.values()))
+            return result
+        return recorded
+
+    def record(self, results):
+        ''' write the run and its results, in one transaction, and start
+        over for the next run '''
+        if not results:
+            return
+        rows = list()
+        for r in results:
+            rebuilt, files, size = self.outputs.get(r.task, (None, None, None))
+            if files is None:               # built elsewhere, e.g. a worker
+                after = scan_output(r.task)
+                files = len(after)
+                size = sum(s for _, s in after.values())
+                if r.start is not None:
+                    since = int((r.start - SLACK) * 1e9)
+                    rebuilt = sorted(f for f, (mtime, _) in after.items()
+                                     if mtime >= since)
+            usage = r.usage or dict()
+            start = r.start if r.start is not None else self.started
+            rows.append((os.path.relpath(r.task, self.git_root), start,
+                         start + r.elapsed, r.returncode, r.note,
+                         None if rebuilt is None else json.dumps(rebuilt),
+                         files, size, usage.get('utime'), usage.get('stime'),
+                         usage.get('maxrss')))
+        db = connect(self.git_root)
+        with db:
+            run = db.execute(
+                'insert into runs (started, ended, command, tasks, failed) '
+                'values (?, ?, ?, ?, ?)',
+                (self.started, time.time(), self.command, len(results),
+                 sum(r.returncode != 0 for r in results))).lastrowid
+            db.executemany(
+                'insert into tasks values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                '?)', [(run,) + row for row in rows])
+        db.close()
+        self.outputs.clear()
+        self.started = time.time()
+
+
+def slowest(git_root, days=30, limit=20):
+    ''' [(task, builds, mean seconds, most seconds)] for tasks built in the
+        last days, slowest on average first '''
+    db = connect(git_root)
+    rows = db.execute(
+        'select task, count(*), avg(ended - started), max(ended - started) '
+        'from tasks where started > ? and returncode = 0 and note is null '
+        'group by task order by 3 desc limit ?',
+        (time.time() - days * 86400, limit)).fetchall()
+    db.close()
+    return rows
+
+
+def trend(git_root, days=30, limit=20):
+    ''' [(task, mean seconds in the days before that, mean seconds in the
+        last days, ratio)] for tasks built in both, most slowed first '''
+    now = time.time()
+    db = connect(git_root)
+    rows = db.execute(
+        'select task, '
+        'avg(case when started <= ? then ended - started end), '
+        'avg(case when started > ? then ended - started end) '
+        'from tasks where started > ? and returncode = 0 and note is null '
+        'group by task',
+        (now - days * 86400, now - days * 86400,
+         now - 2 * days * 86400)).fetchall()
+    db.close()
+    rows = [(task, then, recent, recent / then) for task, then, recent in rows
+            if then and recent is not None]
+    return sorted(rows, key=lambda r: -r[3])[:limit]
+
+
+def frequency(git_root, days=30, limit=20):
+    ''' [(task, times run, times it rewrote an output, last run)] for the
+        last days, most often changed first '''
+    db = connect(git_root)
+    rows = db.execute(
+        "select task, count(*), "
+        "sum(rebuilt is not null and rebuilt != '[]'), max(started) "
+        "from tasks where started > ? group by task "
+        "order by 3 desc, 2 desc limit ?",
+        (time.time() - days * 86400, limit)).fetchall()
+    db.close()
+    return rows
+
+
+def print_report(git_root, query, days=30, file=sys.stdout):
+    ''' one of the queries above, as a table '''
+    if query == 'slowest':
+        print(f"{'builds':>6} {'mean s':>9} {'most s':>9}  task", file=file)
+        for task, n, mean, most in slowest(git_root, days):
+            print(f"{n:6d} {mean:9.1f} {most:9.1f}  {task}", file=file)
+    elif query == 'trend':
+        print(f"{'before s':>9} {'recent s':>9} {'change':>7}  task",
+              file=file)
+        for task, then, recent, ratio in trend(git_root, days):
+            print(f"{then:9.1f} {recent:9.1f} {ratio - 1:+7.0%}  {task}",
+                  file=file)
+    elif query == 'frequency':
+        print(f"{'runs':>6} {'changed':>7}  {'last run':<16}  task",
+              file=file)
+        for task, n, changed, last in frequency(git_root, days):
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(last))
+            print(f"{n:6d} {changed:7d}  {when:<16}  {task}", file=file)
+    else:
+        errmsg = f"no history query called {query}"
+        raise ValueError(errmsg)
+
+
+# done.
@@ -0,0 +1,269 @@
+#! /usr/bin/env python3
+''' keep a task graph in memory and rebuild what a file change affects '''
+# -*- mode: python; fill-column: 79; comment-column: 50 -*-
+#
+# Maintainer: PB
+# Created:    20261018
+# License:    (c) 2018 HRDAG, GPL-v2 or greater
+# ============================================
+#
+# the watcher follows every task upstream of a starting task.  it watches
+# each task's directory and its leaf directories except output/ (which
+# builds write to) with inotify, or by polling their stat signatures
+# where inotify isn't available.  a burst of changes is collected until
+# things go quiet, then the changed tasks and everything downstream of
+# them are made, in dependency order.  a changed makefile re-reads only
+# that task's prereqs.
+#
+# :on stderr: what changed and what was rebuilt
+# ============================================
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+import makr as ut
+
+WATCHED_LEAVES = ("input", "src", "frozen", "hand")
+MAKEFILES = ("Makefile", "makefile", "GNUmakefile")
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+           IN_CREATE | IN_DELETE)
+EVENT = struct.Struct('iIII')
+
+
+class InotifyBackend:
+    ''' directory watches through inotify(7), via ctypes '''
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = dict()                  # watch descriptor -> dir
+        self.recursive = set()
+
+    def add(self, dirname, recursive=False):
+        ''' watch dirname; if recursive, also subdirectories created in it
+            later (existing ones have to be added) '''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirname),
+                                         IN_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"can't watch {dirname}")
+        self.dirs[wd] = Path(dirname)
+        if recursive:
+            self.recursive.add(wd)
+
+    def _read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return list()
+        data = os.read(self.fd, 1 << 16)
+        paths = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd not in self.dirs:
+                continue
+            path = self.dirs[wd] / os.fsdecode(name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and \
+                    wd in self.recursive:
+                self.add(path, recursive=True)
+            paths.append(path)
+        return paths
+
+    def wait(self, timeout=None, debounce=0.3):
+        ''' block until something changes, then until nothing has changed
+            for debounce seconds.  return the set of changed paths '''
+        changed = set(self._read(timeout))
+        while changed:
+            more = self._read(debounce)
+            if not more:
+                break
+            changed.update(more)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend:
+    ''' directory watches by comparing the stat signatures of the entries
+        of each watched directory every interval seconds '''
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.dirs = dict()                  # dir -> {path: signature}
+        self.recursive = set()
+
+    def _scan(self, dirname):
+        entries = dict()
+        try:
+            with os.scandir(dirname) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    path = Path(entry.path)
+                    entries[path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+                    if dirname in self.recursive and path not in self.dirs \
+                            and entry.is_dir(follow_symlinks=False):
+                        self.dirs[path] = None
+                        self.recursive.add(path)
+        except OSError:
+            pass
+        return entries
+
+    def add(self, dirname, recursive=False):
+        ''' as InotifyBackend.add '''
+        dirname = Path(dirname)
+        if recursive:
+            self.recursive.add(dirname)
+        self.dirs[dirname] = self._scan(dirname)
+
+    def _poll(self):
+        changed = set()
+        for dirname, before in list(self.dirs.items()):
+            after = self._scan(dirname)
+            if before is not None:
+                changed.update(p for p in set(before) | set(after)
+                               if before.get(p) != after.get(p))
+            self.dirs[dirname] = after
+        return changed
+
+    def wait(self, timeout=None, debounce=0.3):
+        ''' as InotifyBackend.wait '''
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            time.sleep(self.interval)
+            changed = self._poll()
+        while True:
+            time.sleep(max(debounce, self.interval))
+            more = self._poll()
+            if not more:
+                return changed
+            changed.update(more)
+
+    def close(self):
+        pass
+
+
+def make_backend(poll=None):
+    ''' inotify if we can, else polling every poll (or 1) seconds '''
+    if poll is None:
+        try:
+            return InotifyBackend()
+        except (OSError, AttributeError):
+            pass
+    return PollingBackend(poll or 1.0)
+
+
+class Watcher:
+    ''' the upstream graph of base_task, kept current as files change '''
+    def __init__(self, base_task, backend=None, jobs=1, debounce=0.3,
+                 build=ut.build_task, report=ut.print_result):
+        base_task = Path(base_task).resolve()
+        self.resolver = ut.TaskResolver(cwd=base_task)
+        self.base_task = self.resolver.task_path(base_task)
+        self.backend = backend or make_backend()
+        self.jobs = jobs
+        self.debounce = debounce
+        self.build = build
+        self.report = report
+        self.graph = ut.TaskGraph(tasks=[self.base_task])
+        self.watched = set()
+        self.add_upstream(self.base_task)
+
+    def add_upstream(self, task):
+        ''' put task's upstream graph into ours, and watch any new tasks '''
+        for prereq, downstream in ut.discover_graph(task):
+            self.graph.add_edge(prereq, downstream)
+        for each in self.graph.tasks:
+            self.watch(each)
+
+    def watch(self, task):
+        if task in self.watched:
+            return
+        self.watched.add(task)
+        self.backend.add(task)
+        for leaf in WATCHED_LEAVES:
+            top = Path(task) / leaf
+            if not top.is_dir():
+                continue
+            for dirpath, dirnames, _ in os.walk(top):
+                self.backend.add(dirpath, recursive=True)
+
+    def owner(self, path):
+        ''' the watched task a changed path is in, without following
+            symlinks, or None '''
+        path = Path(path)
+        for parent in [path] + list(path.parents):
+            if str(parent) in self.watched:
+                return str(parent)
+        return None
+
+    def refresh(self, task):
+        ''' re-read task's makefile and replace the edges into it '''
+        deps = ut.load_make_db(task)[0].deps()
+        prereqs = ut.get_tasks_from_deps(task, deps, resolver=self.resolver)
+        self.graph.set_upstream(task, prereqs)
+        for prereq in prereqs:
+            if prereq not in self.watched:
+                self.add_upstream(prereq)
+
+    def process(self, paths):
+        ''' rebuild what paths affect.  return the TaskResults '''
+        changed = set()
+        for path in paths:
+            path = Path(path)
+            task = self.owner(path)
+            if task is None:
+                continue
+            if str(path.parent) == task and path.name not in MAKEFILES \
+                    and path.name not in WATCHED_LEAVES:
+                continue                    # READMEs, output/ and such
+            changed.add(task)
+            if path.name in MAKEFILES:
+                self.refresh(task)
+        if not changed:
+            return list()
+        todo = self.graph.subgraph(self.graph.downstream_of(changed))
+        print(f"makr: {len(changed)} changed, {len(todo)} to make",
+              file=sys.stderr)
+        return ut.run_tasks(todo, jobs=self.jobs, report=self.report,
+                            build=self.build)
+
+    def run(self, rounds=None):
+        ''' wait for changes and rebuild, forever or for some rounds '''
+        try:
+            while rounds is None or rounds > 0:
+                paths = self.backend.wait(debounce=self.debounce)
+                self.process(paths)
+                if rounds is not None:
+                    rounds -= 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.backend.close()
+
+
+# done.
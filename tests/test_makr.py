@@ -11,6 +11,9 @@
 # execute with `python setup.py test` from git directory
 
 import os
+import re
+import functools
+import json
 import time
 import subprocess
 from pathlib import Path
@@ -18,6 +21,13 @@ import pytest
 import sys
 
 import makr as ut
+import makr.bench as bench
+import makr.watch as watch
+import makr.daemon as daemon
+import makr.engine as engine
+import makr.cluster as cluster
+import makr.history as history
+import makr.artifacts as artifacts
 MODULE_PATH = Path.cwd() / 'tests'
 
 
@@ -101,6 +111,24 @@ def test_get_task_path_notproj():
         ut.get_task_path(Path.home())
 
 
+def test_task_resolver():
+    resolver = ut.TaskResolver()
+    for fname in ['data/task-2', 'data/task-2/output/cast.csv',
+                  'data/task-1/input/cast.csv', 'data/task-3/src/counter.py']:
+        assert resolver.task_path(fname) == ut.get_task_path(fname)
+    task_2 = Path(apath('task-2'))
+    assert resolver.tasks[task_2 / 'output'] == task_2
+    with pytest.raises(OSError):
+        resolver.task_path(Path.home())
+
+
+def test_task_resolver_outside_git(tmp_path):
+    (tmp_path / 'task' / 'src').mkdir(parents=True)
+    resolver = ut.TaskResolver()
+    with pytest.raises(OSError):
+        resolver.task_path(tmp_path / 'task' / 'src')
+
+
 def test_exec_make_empty_args():
     with pytest.raises(TypeError):
         ut.exec_make()
@@ -169,6 +197,225 @@ def test_get_deps_from_make_4():
                     'src/write-report.py']
 
 
+def test_make_database_rules(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'Makefile').write_text(
+        "X := 3\n"
+        ".PHONY: all clean\n"
+        "all: out/a.txt out/b.txt\n"
+        "out/a.txt: src/a.py in/x.csv | out\n\techo $@: done\n"
+        "out/b.txt:: src/b.py\n\techo b\n"
+        "out/c.txt: X = 5\n"
+        "out/%.csv: src/%.py\n\techo $<\n"
+        "out:\n\tmkdir -p out\n")
+    db = ut.read_make_db(tmp_path)
+    rule = db.rules['out/a.txt']
+    assert rule.prereqs == ['src/a.py', 'in/x.csv']
+    assert rule.order_only == ['out']
+    assert db.rules['out/b.txt'].double_colon
+    assert db.phony == {'all', 'clean'}
+    assert [r.target for r in db.patterns if r.target.startswith('out/')] \
+        == ['out/%.csv']
+    assert db.variables['X'] == '3'
+    assert db.makefiles == ['Makefile']
+    assert db.deps() == ['in/x.csv', 'out', 'src/a.py', 'src/b.py']
+    assert db.deps('out/b.txt') == ['src/b.py']
+    with pytest.raises(RuntimeError):
+        db.deps('out/nope.txt')
+
+
+def test_read_makefile_matches_make():
+    for task in ['task-0', 'task-1', 'task-2', 'task-3', 'task-4']:
+        fast = ut.read_makefile(apath(task))
+        assert fast.deps() == ut.get_deps_from_make(apath(task))
+        assert fast.phony == {'all', 'clean'}
+    fast = ut.read_makefile(apath('task-3'))
+    assert fast.deps('output/counts-w-agg.json') == ut.get_deps_from_make(
+        apath('task-3'), target='output/counts-w-agg.json')
+    assert fast.makefiles == ['Makefile']
+    assert ut.read_makefile(apath('task-1')).makefiles == ['src/Makefile']
+
+
+def test_read_makefile_fallback(tmp_path):
+    (tmp_path / 'src').mkdir()
+    for text in ["include other.mk\n",
+                 "out/x: $(shell ls src)\n",
+                 "out/%.csv: src/%.py\n",
+                 "ifdef X\nout/x: src/a\nendif\n",
+                 "out/x:: src/a\n",
+                 "out/x out/y &: src/a\n",
+                 "out/x out/y&: src/a\n"]:
+        (tmp_path / 'Makefile').write_text(text)
+        assert ut.read_makefile(tmp_path) is None
+    (tmp_path / 'Makefile').write_text("A = b\nout/x: src/a \\\n\tsrc/b\n")
+    assert ut.read_makefile(tmp_path).deps() == ['src/a', 'src/b']
+
+
+def test_verify_reader():
+    report = ut.verify_reader(apath('.'))
+    assert [s for t, s, d in report] == ['ok'] * 5
+
+
+def test_query_targets(tmp_path):
+    report = bench.make_project(tmp_path / 'proj', ntasks=12, seed=9)
+    graph, _ = ut.make_plan(report)
+    tasks = sorted(graph.tasks) + [str(tmp_path)]
+    errors = dict()
+    found = ut.query_targets(tasks, jobs=4, errors=errors)
+    assert list(errors) == [str(tmp_path)]
+    for task in graph.tasks:
+        assert set(found[task]) == {'all', 'clean', 'output/out.txt'}
+        out = found[task]['output/out.txt']
+        assert out['prereqs'] == ut.get_deps_from_make(task, 'output/out.txt')
+        assert {t for t in out['tasks'].values() if t} == \
+            set(graph.upstream[task])
+    one = ut.query_targets([report], targets=['all'], fast=False)
+    assert one == {report: {'all': found[report]['all']}}
+    with pytest.raises(RuntimeError):
+        ut.query_targets([report], targets=['nosuchtarget'])
+
+
+def test_artifact_store(tmp_path, monkeypatch):
+    root = tmp_path / 'proj'
+    report = bench.make_project(root, ntasks=6, seed=10)
+    graph, _ = ut.make_plan(report)
+    store = artifacts.ArtifactStore(tmp_path / 'store', git_root=root)
+    ut.make_all(report, artifacts=store)
+    assert store.counts['misses'] == store.counts['stored'] == len(graph)
+    for task in graph.tasks:
+        os.remove(Path(task, 'output', 'out.txt'))
+    store = artifacts.ArtifactStore(tmp_path / 'store', git_root=root,
+                                    link=True)
+    results = ut.make_all(report, artifacts=store)
+    assert {r.note for r in results} == {'restored'}
+    assert ut.make_plan(report)[1] == dict()
+    out = Path(report, 'output', 'out.txt')
+    assert out.read_text() == 'ok\n' and out.stat().st_nlink == 2
+    assert store.stats()['hits'] == len(graph)
+    task = sorted(t for t in graph.tasks if graph.downstream[t])[0]
+    time.sleep(0.05)
+    Path(task, 'hand', 'h0.txt').write_text('changed\n')
+    results = ut.make_all(report, artifacts=store)
+    notes = {r.task: r.note for r in results}
+    assert notes.pop(task) is None                  # made, and the rest have
+    assert set(notes.values()) == {'restored'}      # the same inputs again
+    assert Path(task, 'output', 'out.txt').stat().st_nlink == 1
+    assert len(store.entries()) == len(graph) + 1
+    linked = sorted(t for t in graph.tasks if t != task)[0]
+    stored = Path(linked, 'output', 'out.txt')
+    assert stored.stat().st_nlink == 2
+    Path(linked, 'src', 'run.sh').write_text('#!/bin/sh\necho changed\n')
+    store = artifacts.ArtifactStore(tmp_path / 'store', git_root=root)
+    ut.make_all(report, artifacts=store)            # no hardlinks this time
+    assert stored.read_text() == 'changed\n' and stored.stat().st_nlink == 1
+    assert {(e[2] / 'files' / 'out.txt').read_text()
+            for e in store.entries()} == {'ok\n', 'changed\n'}
+    def no_link(src, dst):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', no_link)
+    os.remove(out)
+    store = artifacts.ArtifactStore(tmp_path / 'store', git_root=root,
+                                    link=True)
+    assert store.restore(report, store.key(report))
+    assert out.stat().st_nlink == 1 and out.stat().st_mode & 0o777 == 0o644
+    store = artifacts.ArtifactStore(tmp_path / 'store', git_root=root, cap=4)
+    used = store.entries()[0][2]                    # the least recently,
+    os.utime(used / 'manifest.json', (time.time() + 60,) * 2)    # until now
+    store.evict()
+    assert [e[2] for e in store.entries()] == [used]
+
+
+def test_find_tasks(tmp_path):
+    for name in ['a/t1/src', 'a/t1/input/deep/t2/src', 'b/c/t3/output',
+                 '.git/t4/src', 'd/e']:
+        (tmp_path / name).mkdir(parents=True)
+    (tmp_path / 'link').symlink_to(tmp_path / 'a')
+    (tmp_path / 'b/t5').mkdir()
+    (tmp_path / 'b/t5/hand').symlink_to(tmp_path / 'd')
+    tasks = ut.find_tasks(tmp_path, jobs=4)
+    assert [os.path.relpath(t, tmp_path) for t in tasks] == \
+        ['a/t1', 'b/c/t3', 'b/t5']
+    assert ut.find_tasks(apath('.')) == [apath(f'task-{i}') for i in range(5)]
+
+
+def test_index_repo(tmp_path):
+    report = bench.make_project(tmp_path / 'proj', ntasks=30, seed=5)
+    (tmp_path / 'proj' / 'loose' / 'src').mkdir(parents=True)
+    root = str(tmp_path / 'proj')
+    errors = dict()
+    graph = ut.index_repo(root, jobs=4, errors=errors)
+    assert errors == dict()
+    assert len(graph) == 32
+    assert graph.pairs() == ut.discover_graph(report)
+    exported = ut.graph_json(graph, root)
+    assert len(exported['edges']) == len(graph.pairs())
+    assert 'loose' in exported['tasks']
+    dot = ut.graph_dot(graph, root)
+    assert dot.count(' -> ') == len(graph.pairs())
+    assert '"task-0000";' in dot
+
+
+def test_make_downstream(tmp_path):
+    report = bench.make_project(tmp_path / 'proj', ntasks=20, seed=6)
+    ut.make_all(report)
+    graph = ut.index_repo(str(tmp_path / 'proj'))
+    task = sorted(t for t in graph.tasks if graph.downstream[t])[3]
+    outputs = {t: Path(t, 'output', 'out.txt') for t in graph.tasks}
+    before = {t: out.stat().st_mtime_ns for t, out in outputs.items()}
+    time.sleep(0.05)
+    (Path(task) / 'hand' / 'h1.txt').write_text('changed\n')
+    results = ut.make_downstream([str(Path(task) / 'hand' / 'h1.txt')])
+    expected = graph.downstream_of([task])
+    assert {r.task for r in results} == set(expected)
+    assert all(r.returncode == 0 for r in results)
+    order = [r.task for r in results]
+    assert all(order.index(a) < order.index(b)
+               for a, b in graph.subgraph(expected).pairs())
+    for t, out in outputs.items():
+        moved = out.stat().st_mtime_ns != before[t]
+        assert moved == (t in expected)
+
+
+def test_make_downstream_source(tmp_path):
+    subprocess.run(['git', 'init', '-q', str(tmp_path)], check=True)
+    raw = tmp_path / 'raw'
+    (raw / 'input').mkdir(parents=True)
+    (raw / 'input' / 'data.csv').write_text('a\n')
+    clean = tmp_path / 'clean'
+    (clean / 'src').mkdir(parents=True)
+    (clean / 'Makefile').write_text(
+        'output/data.csv: ../raw/input/data.csv\n'
+        '\tmkdir -p output; cp $< $@\n')
+    results = ut.make_downstream([str(raw / 'input' / 'data.csv')])
+    assert [(r.task, r.returncode) for r in results] == [(str(clean), 0)]
+    assert (clean / 'output' / 'data.csv').read_text() == 'a\n'
+
+
+def test_build_log(tmp_path):
+    root = tmp_path / 'proj'
+    report = bench.make_project(root, ntasks=6, seed=8)
+    graph, _ = ut.make_plan(report)
+    ut.make_all(report, log=history.BuildLog(root, command='first'))
+    ut.make_all(report, log=history.BuildLog(root, command='second'))
+    db = history.connect(root)
+    runs = db.execute('select command, tasks, failed from runs').fetchall()
+    rows = db.execute('select task, returncode, rebuilt, output_files '
+                      'from tasks order by run').fetchall()
+    db.close()
+    assert runs == [('first', len(graph), 0)]        # nothing ran the 2nd time
+    assert {r[0] for r in rows} == {os.path.relpath(t, root)
+                                    for t in graph.tasks}
+    assert all(rc == 0 and json.loads(rebuilt) == ['out.txt'] and n == 1
+               for _, rc, rebuilt, n in rows)
+    slow = history.slowest(root)
+    assert len(slow) == len(graph) and all(n == 1 for _, n, _, _ in slow)
+    assert [n for _, n, changed, _ in history.frequency(root)] == \
+        [1] * len(graph)
+    assert history.trend(root) == list()
+    with pytest.raises(ValueError):
+        history.print_report(root, 'fastest')
+
+
 def test_get_task_from_dep0():
     base_task = "data/task-0"
     deps = ut.get_deps_from_make(base_task)
@@ -222,6 +469,63 @@ def test_follow_deps4():
     assert exp_pairs == obs_pairs
 
 
+def test_discover_graph_stats():
+    stats = dict()
+    pairs = ut.discover_graph("data/task-4", stats=stats, fast=False)
+    assert pairs == ut.follow_deps("data/task-4")
+    assert stats['queried'] == 5
+    # task-0 is reached by 4 paths, task-1 by 2, the rest by 1
+    assert stats['saved'] == (4 + 2 + 1 + 1 + 1) - 5
+
+
+def test_discover_graph_jobs():
+    stats = dict()
+    pairs = ut.discover_graph("data/task-4", stats=stats, jobs=4)
+    assert pairs == ut.follow_deps("data/task-4")
+    assert stats['read'] == 5
+
+
+def test_get_task_path_base():
+    os.chdir('/')
+    base = apath('task-1')
+    assert ut.get_task_path('input/cast.csv', base=base) == apath('task-0')
+    assert ut.get_task_path('src', base=base) == base
+
+
+def test_count_paths():
+    pairs = [(0, 1), (0, 2), (1, 3), (2, 3)]
+    assert ut.count_paths(pairs, 3) == {3: 1, 2: 1, 1: 1, 0: 2}
+
+
+def test_dep_cache_roundtrip():
+    cache = ut.DepCache()
+    cache.entries = dict()
+    pairs = ut.discover_graph("data/task-4", cache=cache)
+    stats = dict()
+    warm = ut.DepCache()
+    assert ut.discover_graph("data/task-4", stats=stats, cache=warm) == pairs
+    assert stats['queried'] == stats['read'] == 0
+    assert stats['cached'] == 5
+    assert ut.check_cache("data/task-4", warm) == list()
+
+
+def test_dep_cache_makefile_touched():
+    cache = ut.DepCache()
+    ut.discover_graph("data/task-2", cache=cache)
+    # same content, new mtime: entry survives a re-hash
+    subprocess.run(['touch', 'data/task-2/Makefile'])
+    assert ut.DepCache().lookup(apath('task-2')) is not None
+
+
+def test_dep_cache_makefile_changed():
+    cache = ut.DepCache()
+    ut.discover_graph("data/task-2", cache=cache)
+    key = cache._key(apath('task-2'))
+    cache.entries[key]['makefiles']['Makefile'] = [0, 0, 'stale']
+    assert cache.lookup(apath('task-2')) is None
+    assert key not in cache.entries
+
+
 def test_topo_sort_a():
     pairs = [(0, 1), (1, 2)]
     exp_q = [0, 1, 2]
@@ -235,6 +539,33 @@ def test_topo_sort_cycle():
         ut.topological_sort(pairs)
 
 
+def test_topo_sort_cycle_named():
+    pairs = [(0, 1), (1, 2), (2, 1), (2, 3), (4, 4)]
+    with pytest.raises(ut.CycleError) as err:
+        ut.topological_sort(pairs)
+    cycles = sorted((sorted(tasks), sorted(edges))
+                    for tasks, edges in err.value.cycles)
+    assert cycles == [([1, 2], [(1, 2), (2, 1)]), ([4], [(4, 4)])]
+
+
+def test_task_graph_levels():
+    graph = ut.TaskGraph([(0, 1), (0, 2), (1, 3), (2, 3)], tasks=[5])
+    assert graph.levels() == [[5, 0], [1, 2], [3]]
+    assert graph.upstream_of([1]) == {0, 1}
+    assert graph.downstream_of([1]) == {1, 3}
+
+
+def test_task_graph_large():
+    # 100k edges: each task depends on the 10 before it
+    pairs = [(i - k, i) for i in range(10, 10010) for k in range(1, 11)]
+    start = time.process_time()             # not slowed by a busy host
+    order = ut.TaskGraph(pairs).order()
+    assert time.process_time() - start < 1
+    pos = {t: i for i, t in enumerate(order)}
+    assert len(order) == 10010
+    assert all(pos[p] < pos[t] for p, t in pairs)
+
+
 def test_topo_sort2():
     base_task = "data/task-2"
     pairs = ut.follow_deps(base_task)
@@ -243,6 +574,476 @@ def test_topo_sort2():
     assert obs_seq == [0, 1, 2]
 
 
+def mktask(root, name, recipe):
+    ''' a throwaway task whose `all` runs recipe '''
+    task = Path(root) / name
+    (task / 'src').mkdir(parents=True)
+    (task / 'Makefile').write_text(f".PHONY: all\nall:\n\t{recipe}\n")
+    return str(task)
+
+
+def test_engine_prefix_and_log(tmp_path):
+    import io
+    task = mktask(tmp_path, 't0', 'echo one; echo two >&2; printf three')
+    out, err = io.StringIO(), io.StringIO()
+    with engine.Engine(tmp_path, out=out, err=err) as eng:
+        result = eng.build(task)
+    assert result.returncode == 0 and result.usage is not None
+    assert 't0| one\n' in out.getvalue()
+    assert 't0| three\n' in out.getvalue()
+    assert err.getvalue() == 't0| two\n'
+    log = (tmp_path / '.makr' / 'logs' / 't0.log').read_text()
+    assert 'one\n' in log and 'two\n' in log
+
+
+def test_engine_timeout_and_cancel(tmp_path):
+    import io
+    slow = mktask(tmp_path, 'slow', 'sleep 30 & sleep 30')
+    eng = engine.Engine(tmp_path, timeout=0.3, out=io.StringIO(),
+                        err=io.StringIO())
+    result = eng.build(slow)
+    assert result.note == 'timeout' and result.returncode != 0
+    assert result.elapsed < 5
+    eng.timeout = None
+    future = eng.submit(eng.build_async(slow))
+    time.sleep(0.3)
+    eng.cancel()
+    with pytest.raises(Exception):
+        future.result(timeout=5)
+    eng.close()
+    prox = subprocess.run(['pgrep', '-f', 'sleep 30'], capture_output=True)
+    assert prox.stdout == b''
+
+
+def test_engine_runs_tasks(tmp_path):
+    import io
+    tasks = [mktask(tmp_path, f't{i}', 'sleep 0.5') for i in range(3)]
+    with engine.Engine(tmp_path, out=io.StringIO()) as eng:
+        results = ut.run_tasks(ut.TaskGraph(tasks=tasks), jobs=3,
+                               build=eng.build)
+        db = eng.read_make_db(apath('task-3'))
+    first_end = min(r.start + r.elapsed for r in results)
+    assert all(r.start < first_end for r in results)      # all at once
+    assert all(r.returncode == 0 for r in results)
+    assert db.deps() == ut.get_deps_from_make(apath('task-3'))
+
+
+def test_cluster_local_workers(tmp_path):
+    tasks = [mktask(tmp_path, f't{i}', 'sleep 0.3') for i in range(4)]
+    pairs = [(tasks[0], tasks[3]), (tasks[1], tasks[3]), (tasks[2], tasks[3])]
+    with cluster.Coordinator(tmp_path / 'c.sock') as coordinator:
+        coordinator.start_workers(3)
+        results = coordinator.run_tasks(ut.TaskGraph(pairs))
+        assert [r.task for r in results][-1] == tasks[3]
+        assert all(r.returncode == 0 for r in results)
+        assert coordinator.run_tasks(ut.TaskGraph(tasks=tasks[:1]))
+        metrics = coordinator.metrics()
+    assert sum(m['tasks'] for m in metrics.values()) == 5
+    assert all(m['wait_max'] >= 0 for m in metrics.values())
+    assert len(metrics) == 3
+
+
+def test_cluster_build_log(tmp_path):
+    import threading
+    root = tmp_path / 'proj'
+    report = bench.make_project(root, ntasks=4, seed=11)
+    address = str(tmp_path / 'c.sock')
+    with cluster.Coordinator(address, patience=5) as coordinator:
+        worker = threading.Thread(target=cluster.work, args=(address, 'w'))
+        worker.start()
+        results = ut.make_all(report, executor=coordinator.run_tasks,
+                              log=history.BuildLog(root))
+    worker.join()
+    db = history.connect(root)
+    rebuilt = db.execute('select rebuilt from tasks').fetchall()
+    db.close()
+    assert len(rebuilt) == len(results)
+    assert all(json.loads(r) == ['out.txt'] for r, in rebuilt)
+
+
+def test_cluster_budget(tmp_path):
+    import threading
+    tasks = [mktask(tmp_path, f't{i}', 'sleep 0.2') for i in range(3)]
+    budget = ut.Resources(1, None)
+    needs = {t: ut.Resources(1, 0) for t in tasks}
+    address = str(tmp_path / 'c.sock')
+    with cluster.Coordinator(address, patience=5) as coordinator:
+        workers = [threading.Thread(target=cluster.work, args=(address, n))
+                   for n in ('a', 'b')]
+        for worker in workers:
+            worker.start()
+        results = coordinator.run_tasks(ut.TaskGraph(tasks=tasks),
+                                        needs=needs, budget=budget)
+    for worker in workers:
+        worker.join()
+    assert len(results) == 3
+    assert ut.budget_use(results, needs, budget)['peak'].cpus <= 1
+
+
+def test_cluster_requeue_and_make_all(tmp_path):
+    import socket
+    import threading
+    report = bench.make_project(tmp_path / 'proj', ntasks=8, seed=7)
+    address = str(tmp_path / 'c.sock')
+    with cluster.Coordinator(address, patience=5) as coordinator:
+        def flaky():
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(address)
+                with sock.makefile('rwb') as f:
+                    cluster.send(f, {'worker': 'flaky'})
+                    assert cluster.recv(f)['task']
+        quitter = threading.Thread(target=flaky)
+        quitter.start()
+        time.sleep(0.2)
+        worker = threading.Thread(target=cluster.work, args=(address, 'w'))
+        worker.start()
+        results = ut.make_all(report, executor=coordinator.run_tasks)
+        quitter.join()
+    worker.join()
+    graph, stale = ut.make_plan(report)
+    assert stale == dict()
+    assert len(results) == len(graph)
+    assert coordinator.metrics()['w']['tasks'] == len(graph)
+
+
+def test_task_needs(tmp_path):
+    assert ut.parse_size('512M') == 512 << 20
+    assert ut.parse_size('1.5g') == 3 << 29
+    assert ut.parse_size(64) == 64 << 20
+    with pytest.raises(ValueError):
+        ut.parse_size('lots')
+    plain = mktask(tmp_path, 'plain', 'true')
+    assert ut.task_needs(plain) == ut.Resources(1, 0)
+    declared = mktask(tmp_path, 'declared', 'true')
+    makefile = Path(declared) / 'Makefile'
+    makefile.write_text('MAKR_CPUS = 4\nMAKR_MEM = 2G\n' +
+                        makefile.read_text())
+    assert ut.task_needs(declared) == ut.Resources(4, 2 << 30)
+    (Path(declared) / 'makr.conf').write_text('# big\nMAKR_MEM=10G\n')
+    assert ut.task_needs(declared) == ut.Resources(1, 10 << 30)
+    (Path(declared) / 'makr.conf').write_text('MAKR_CPUS = $(NCPU)\n')
+    assert ut.task_needs(declared) == ut.Resources(1, 0)
+
+
+def test_run_tasks_budget(tmp_path):
+    heavy = [mktask(tmp_path, f'heavy{i}', 'sleep 0.3') for i in range(3)]
+    light = mktask(tmp_path, 'light', 'sleep 0.3')
+    needs = {t: ut.Resources(1, 6 << 30) for t in heavy}
+    needs[light] = ut.Resources(1, 1 << 30)
+    budget = ut.Resources(4, 10 << 30)
+    graph = ut.TaskGraph(tasks=heavy + [light])
+    results = ut.run_tasks(graph, jobs=4, needs=needs, budget=budget)
+    spans = {r.task: (r.start, r.start + r.elapsed) for r in results}
+    for a in heavy:
+        for b in heavy:
+            if a < b:
+                assert spans[a][1] <= spans[b][0] or \
+                    spans[b][1] <= spans[a][0]
+    assert spans[light][0] < min(spans[t][1] for t in heavy)
+    use = ut.budget_use(results, needs, budget)
+    assert use['peak'].mem <= budget.mem
+    assert 0 < use['mem'] <= 1 and 0 < use['cpus'] <= 1
+    with pytest.raises(RuntimeError):
+        ut.run_tasks(graph, jobs=0)
+    giant = {heavy[0]: ut.Resources(16, 0)}
+    results = ut.run_tasks(ut.TaskGraph(tasks=heavy[:1]), needs=giant,
+                           budget=budget)
+    assert results[0].returncode == 0
+
+
+def test_jobserver_caps_total_jobs(tmp_path):
+    log = tmp_path / 'log'
+    tasks = list()
+    for name in ('t0', 't1'):
+        task = Path(mktask(tmp_path, name, 'true'))
+        step = (f'echo s $$(date +%s%N) >> {log}; sleep 0.3; '
+                f'echo e $$(date +%s%N) >> {log}')
+        (task / 'Makefile').write_text(
+            'MAKR_CPUS = 4\n.PHONY: all a b c d\nall: a b c d\n'
+            f'a b c d:\n\t{step}\n')
+        tasks.append(str(task))
+    with ut.Jobserver(3) as jobserver:
+        assert '--jobserver-auth=' in ut.make_kwargs()['env']['MAKEFLAGS']
+        assert '-j3' in ut.make_kwargs(tasks[0])['env']['MAKEFLAGS']
+        results = ut.run_tasks(ut.TaskGraph(tasks=tasks), jobs=2,
+                               build=jobserver.holding(ut.build_task))
+    assert ut.make_kwargs() == dict()
+    assert all(r.returncode == 0 for r in results)
+    running = most = 0
+    events = sorted((int(t), kind == 's') for kind, t in
+                    (line.split() for line in log.read_text().splitlines()))
+    for _, starting in events:
+        running += 1 if starting else -1
+        most = max(most, running)
+    assert len(events) == 16
+    assert most == 3
+
+
+def test_jobserver_serial_tasks(tmp_path):
+    # like task-4's report rule: one recipe writes both targets, so under
+    # -j make would run it twice at once
+    task = Path(mktask(tmp_path, 'report', 'true'))
+    (task / 'input.txt').write_text('x\n')
+    (task / 'Makefile').write_text(
+        'all: output/report.md output/timings.json\n'
+        'output/report.md output/timings.json: input.txt\n'
+        '\techo run >> runs; sleep 0.2; mkdir -p output; '
+        'touch output/report.md output/timings.json\n')
+    with ut.Jobserver(3) as jobserver:
+        kwargs = ut.make_kwargs(str(task))
+        assert 'pass_fds' not in kwargs
+        assert '-j' not in kwargs['env']['MAKEFLAGS']
+        results = ut.run_tasks(ut.TaskGraph(tasks=[str(task)]), jobs=3,
+                               build=jobserver.holding(ut.build_task))
+    assert [r.returncode for r in results] == [0]
+    assert (task / 'runs').read_text() == 'run\n'
+
+
+def test_run_tasks_parallel(tmp_path):
+    tasks = [mktask(tmp_path, f't{i}', 'sleep 0.5') for i in range(3)]
+    pairs = [(tasks[0], tasks[2]), (tasks[1], tasks[2])]
+    results = ut.run_tasks(ut.TaskGraph(pairs), jobs=2)
+    spans = {r.task: (r.start, r.start + r.elapsed) for r in results}
+    assert spans[tasks[0]][0] < spans[tasks[1]][1] and \
+        spans[tasks[1]][0] < spans[tasks[0]][1]           # overlapped
+    assert [r.task for r in results][-1] == tasks[2]
+    assert all(r.returncode == 0 for r in results)
+
+
+def test_run_tasks_failure(tmp_path):
+    bad = mktask(tmp_path, 'bad', 'false')
+    after = mktask(tmp_path, 'after', 'true')
+    results = ut.run_tasks(ut.TaskGraph([(bad, after)]), jobs=2)
+    assert [r.task for r in results] == [bad]
+    assert results[0].returncode != 0
+
+
+def test_run_tasks_keep_going(tmp_path):
+    bad = mktask(tmp_path, 'bad', 'false')
+    after = mktask(tmp_path, 'after', 'true')
+    last = mktask(tmp_path, 'last', 'true')
+    other = mktask(tmp_path, 'other', 'true')
+    graph = ut.TaskGraph([(bad, after), (after, last), (other, last)],
+                         tasks=[other])
+    results = ut.run_tasks(graph, keep_going=True,
+                           priority={bad: 1})          # fail first
+    assert [r.task for r in results] == [bad, other]
+    assert ut.skipped_tasks(graph, results) == {after: [bad], last: [bad]}
+    results = ut.run_tasks(graph, priority={bad: 1})
+    assert ut.skipped_tasks(graph, results) == {after: [bad], last: [bad],
+                                                other: []}
+
+
+def test_exec_make_fails(tmp_path):
+    bad = mktask(tmp_path, 'bad', 'false')
+    with pytest.raises(subprocess.CalledProcessError) as err:
+        ut.exec_make(['make'], cwd=bad)
+    assert err.value.returncode == 2
+
+
+def test_make_all_jobs():
+    subprocess.run(['touch', 'data/task-0/input/cast.csv'])
+    results = ut.make_all("data/task-4", jobs=3)
+    assert len(results) == 5
+    assert all(r.returncode == 0 for r in results)
+
+
+def test_make_all_trace(tmp_path):
+    subprocess.run(['touch', 'data/task-2/src/increment-wts.py'])
+    trace = tmp_path / 'trace.json'
+    results = ut.make_all("data/task-4", jobs=2, trace=str(trace))
+    assert sorted(int(r.task[-1:]) for r in results) == [2, 3, 4]
+    assert all(r.usage['utime'] + r.usage['stime'] > 0 for r in results)
+    assert all(r.usage['maxrss'] > 0 for r in results)
+    events = json.loads(trace.read_text())['traceEvents']
+    assert sorted(e['name'] for e in events) == ['task-2', 'task-3', 'task-4']
+    assert all(e['ph'] == 'X' and e['dur'] > 0 for e in events)
+
+
+def test_trace_lanes():
+    mk = functools.partial(ut.TaskResult, returncode=0)
+    results = [mk('a', elapsed=2, start=0), mk('b', elapsed=1, start=0),
+               mk('c', elapsed=1, start=1), mk('d', elapsed=1, start=2)]
+    assert ut.trace_lanes(results) == {'a': 0, 'b': 1, 'c': 1, 'd': 0}
+
+
+def test_critical_path():
+    # a fans out to a 40-minute fit and a few short tasks, which feed z
+    cost = {'a': 1, 'fit': 40, 's1': 2, 's2': 2, 's3': 2, 'z': 1}
+    pairs = [('a', t) for t in ('s1', 's2', 's3', 'fit')] + \
+        [(t, 'z') for t in ('s1', 's2', 's3', 'fit')]
+    graph = ut.TaskGraph(pairs)
+    priority, path = ut.critical_path(graph, cost.get)
+    assert path == ['a', 'fit', 'z']
+    assert priority['a'] == 42
+    assert ut.simulate(graph, cost.get, jobs=2, priority=priority) == 42
+    assert ut.simulate(graph, cost.get, jobs=2) == 44
+
+
+def test_run_tasks_priority(tmp_path):
+    tasks = [mktask(tmp_path, f't{i}', 'true') for i in range(3)]
+    priority = {tasks[0]: 1, tasks[1]: 5, tasks[2]: 3}
+    results = ut.run_tasks(ut.TaskGraph(tasks=tasks), priority=priority)
+    assert [r.task for r in results] == [tasks[1], tasks[2], tasks[0]]
+
+
+def test_duration_history():
+    history = ut.DurationHistory()
+    history.durations = dict()
+    assert history.estimate(apath('task-0')) == 1.0
+    for seconds in range(20):
+        history.add(apath('task-0'), seconds)
+    assert len(history.durations['tests/data/task-0']) == history.keep
+    assert history.estimate(apath('task-0')) == 15
+    assert history.estimate(apath('task-1')) == 15
+
+
+def test_make_all_noop():
+    ut.make_all("data/task-4")
+    assert ut.make_all("data/task-4") == list()
+
+
+def test_make_plan():
+    ut.make_all("data/task-4")
+    subprocess.run(['touch', 'data/task-2/src/increment-wts.py'])
+    graph, stale = ut.make_plan("data/task-4")
+    assert len(graph) == 5
+    assert sorted(int(t[-1:]) for t in stale) == [2, 3, 4]
+    assert stale[apath('task-2')] == 'out of date'
+    assert stale[apath('task-3')].startswith('upstream')
+
+
+def test_hash_state_incremental():
+    hashes = ut.HashState()
+    fname = apath('task-0/input/cast.csv')
+    sha = hashes.file_hash(fname)
+    hashes.files[fname][1] = 'memo'
+    assert hashes.file_hash(fname) == 'memo'   # same stat, not re-read
+    subprocess.run(['touch', fname])
+    assert hashes.file_hash(fname) == sha
+
+
+def test_make_all_hashes_touch():
+    ut.make_all("data/task-4")
+    hashes = ut.HashState()
+    hashes.tasks = dict()
+    ut.make_all("data/task-4", hashes=hashes)
+    time.sleep(0.25)
+    subprocess.run(['touch', 'data/task-0/input/cast.csv'])
+    results = ut.make_all("data/task-4", hashes=ut.HashState())
+    assert [r.note for r in results] == ['unchanged'] * 5
+    # nothing was rebuilt, and make now agrees everything is current
+    assert ut.make_all("data/task-4") == list()
+
+
+def test_make_all_hashes_change():
+    ut.make_all("data/task-4", hashes=ut.HashState())
+    roles = Path('data/task-1/hand/remapped-roles.json')
+    text = roles.read_text()
+    try:
+        roles.write_text(text + "\n")
+        results = ut.make_all("data/task-4", hashes=ut.HashState())
+        notes = {int(r.task[-1:]): r.note for r in results}
+        assert notes[1] is None                 # rebuilt
+        assert notes[2] == notes[4] == 'unchanged'
+    finally:
+        roles.write_text(text)
+
+
+def test_bench_project(tmp_path):
+    report = bench.make_project(tmp_path / 'proj', ntasks=12, seed=1)
+    pairs = ut.discover_graph(report)
+    assert pairs == ut.discover_graph(report, fast=False)
+    assert len(ut.TaskGraph(pairs)) == 13
+    assert any(Path(report).parent.glob('*/input/*.txt'))
+
+
+def test_bench_run(tmp_path):
+    result = bench.run_benchmark(tmp_path / 'proj', ntasks=6, seed=2)
+    assert set(result['timings']) == {
+        'discover_make', 'discover_fast', 'discover_jobs', 'discover_cached',
+        'sort', 'build', 'noop', 'leaf_change'}
+    slower = dict(result, timings={k: v + 1 for k, v in
+                                   result['timings'].items()})
+    assert bench.compare(result, result) == list()
+    assert len(bench.compare(result, slower)) == 8
+
+
+@pytest.mark.parametrize('poll', [None, 0.05])
+def test_watch_rebuilds_downstream(poll):
+    ut.make_all("data/task-4")
+    watcher = watch.Watcher("data/task-4", backend=watch.make_backend(poll),
+                            debounce=0.1)
+    assert len(watcher.watched) == 5
+    subprocess.run(['touch', 'data/task-2/src/increment-wts.py'])
+    subprocess.run(['touch', 'data/task-2/README.md'])
+    paths = watcher.backend.wait(timeout=2, debounce=0.1)
+    results = watcher.process(paths)
+    watcher.backend.close()
+    assert sorted(int(r.task[-1:]) for r in results) == [2, 3, 4]
+
+
+def test_watch_makefile_refresh(tmp_path):
+    report = bench.make_project(tmp_path / 'proj', ntasks=4, fan_in=1,
+                                symlinks=0, seed=3)
+    watcher = watch.Watcher(report, backend=watch.PollingBackend(0.05))
+    graph = watcher.graph
+    task = sorted(t for t in graph.tasks if graph.upstream[t])[0]
+    makefile = Path(task) / 'Makefile'
+    text = makefile.read_text()
+    makefile.write_text(re.sub(r'\.\./task-\d+/output/out.txt', 'hand/h0.txt',
+                               text))
+    watcher.build = lambda t: ut.TaskResult(t, 0, 0)
+    results = watcher.process([makefile])
+    assert graph.upstream[task] == dict()
+    assert results[0].task == task
+
+
+@pytest.fixture
+def served(tmp_path):
+    import threading
+    report = bench.make_project(tmp_path / 'proj', ntasks=6, seed=4)
+    git_root = daemon.find_git_root(report)
+    server = daemon.Daemon(git_root, idle=30)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    while not daemon.request(git_root, 'ping'):
+        time.sleep(0.01)
+    yield report, server
+    daemon.stop(git_root)
+    thread.join()
+
+
+def test_daemon_plan_matches(served):
+    report, server = served
+    graph, stale = daemon.plan(report)
+    local, local_stale = ut.make_plan(report)
+    assert graph.pairs() == local.pairs()
+    assert stale == local_stale
+    ut.make_all(report, plan=(graph, stale))
+    assert daemon.plan(report)[1] == dict()
+    assert daemon.deps(report) == ut.get_deps_from_make(report)
+    assert daemon.targets(report) == ut.query_targets([report])[report]
+
+
+def test_daemon_invalidates(served):
+    report, server = served
+    graph, _ = daemon.plan(report)
+    task = sorted(t for t in graph.tasks if graph.upstream[t])[0]
+    makefile = Path(task) / 'Makefile'
+    makefile.write_text(re.sub(r'(\.\./task-\d+/output/out.txt|input/\S+)',
+                               'hand/h0.txt', makefile.read_text()))
+    graph, _ = daemon.plan(report)
+    assert graph.upstream[task] == dict()
+    with pytest.raises(RuntimeError):
+        daemon.deps(task, target='nosuchtarget')
+
+
+def test_daemon_absent(tmp_path):
+    assert daemon.plan(tmp_path) is None
+    assert daemon.request(tmp_path, 'ping') is None
+
+
 def test_remake_clean():
     prox = subprocess.run(['./bin/reset.sh'], capture_output=False)
     prox = subprocess.run(['./bin/clean.sh'], capture_output=True)